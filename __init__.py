@@ -1,4 +1,15 @@
-from . import balance
-from . import utils
-from . import assignment
-from . import design
+import importlib
+
+SUBMODULES = ['balance', 'utils', 'assignment', 'design']
+
+
+def __getattr__(name):
+    """imports submodules on first access"""
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES))
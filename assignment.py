@@ -1,6 +1,8 @@
+import lazy_property
 import numpy as np
+import pandas as pd
 from numbers import Number
-from random import shuffle, seed
+from random import shuffle
 from functools import reduce
 from operator import add
 
@@ -13,22 +15,154 @@ def clean_weights(weights):
     return weights
 
 
+class ArmPositions(list):
+    """positions of the units of each arm, from first to last arm, grouped
+    in a single pass over the labels they keep"""
+
+    def __init__(self, labels):
+        self.labels = np.asarray(labels).ravel().astype(int)
+        counts = np.bincount(self.labels)
+        order = np.argsort(self.labels, kind='stable')
+        super().__init__(np.split(order, np.cumsum(counts)[:-1]))
+
+    @lazy_property.LazyProperty
+    def masks(self):
+        return list(self.labels == np.arange(len(self))[:, None])
+
+
+class LabelBatch:
+    """(K, N) matrix of the arm labels of K assignments, with the arm masks
+    balance objectives read computed once"""
+
+    def __init__(self, labels):
+        self.labels = np.atleast_2d(labels)
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.labels, dtype=dtype)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @lazy_property.LazyProperty
+    def masks(self):
+        """(K, N) float mask of each arm"""
+        return [(self.labels == arm).astype(float)
+                for arm in range(int(self.labels.max()) + 1)]
+
+
 def get_assignments_as_positions(assignment):
-    assignment = np.array(assignment)
-    return [np.where(assignment == i)[0]
-            for i in range(np.max(assignment))]
+    return ArmPositions(assignment)
+
+
+def draw_rng(seed, index):
+    """generator for draw number `index` of a design seeded with `seed`,
+    independent of the generators of all other draws"""
+    return np.random.Generator(
+        np.random.Philox(key=seed, counter=[0, index, 0, 0]))
 
 
-def draw_iid_assignment(weights, sample_size):
+def draw_iid_assignment(weights, sample_size, rng=np.random):
     weights = clean_weights(weights)
-    return np.random.choice(
+    return rng.choice(
         range(len(weights)), size=sample_size, replace=True, p=weights)
 
 
-def draw_shuffled_assignment(weights, sample_size):
+def label_dtype(weights):
+    """smallest unsigned integer type holding every arm label"""
+    return np.min_scalar_type(len(clean_weights(weights)) - 1)
+
+
+def shuffled_labels(weights, sample_size):
+    weights = clean_weights(weights)
+    counts = [int(np.ceil(w * sample_size)) for w in weights]
+    return np.repeat(np.arange(len(weights), dtype=label_dtype(weights)),
+                     counts)
+
+
+def draw_iid_assignments(weights, sample_size, size, rng=np.random):
+    """(size, sample_size) array of iid assignments, consuming `rng` as
+    `size` successive calls to `draw_iid_assignment` would"""
+    weights = clean_weights(weights)
+    return rng.choice(len(weights), size=(size, sample_size), replace=True,
+                      p=weights).astype(label_dtype(weights))
+
+
+def draw_shuffled_assignment(weights, sample_size, rng=None):
+    if rng is not None:
+        return rng.permutation(shuffled_labels(weights, sample_size))
     weights = clean_weights(weights)
     treatment_list = [int(np.ceil(w * sample_size)) * [i]
                       for i, w in enumerate(weights)]
     assignment = reduce(add, treatment_list, [])
     shuffle(assignment)
     return assignment
+
+
+def arm_targets(weights, sample_size):
+    """number of units of each arm, the largest remainders of
+    `weights * sample_size` being rounded up so that they sum to
+    `sample_size`"""
+    exact = np.asarray(clean_weights(weights), dtype=float) * sample_size
+    targets = np.floor(exact + 1e-9).astype(int)
+    deficit = sample_size - targets.sum()
+    if deficit > 0:
+        targets[np.argsort(targets - exact, kind='stable')[:deficit]] += 1
+    return targets
+
+
+class StratifiedDraw:
+    """draw function assigning units within strata, given as one integer
+    code per unit: each stratum of n units gets floor(w * n) units of each
+    arm of weight w, and the units left over across strata are pooled and
+    shuffled over the arms short of their `arm_targets`. Units are drawn
+    for all strata at once, and `batch` draws several assignments,
+    consuming `rng` as successive calls would."""
+
+    def __init__(self, strata):
+        self.strata = np.asarray(strata)
+        self.counts = np.bincount(self.strata)
+
+    @classmethod
+    def from_frame(cls, df, cols):
+        """strata of the combinations of values of columns `cols`, numbered
+        in sorted order, missing values being a value of their own sorted
+        last"""
+        codes = []
+        for col in cols:
+            col_codes, uniques = pd.factorize(df[col], sort=True)
+            codes.append(np.where(col_codes < 0, len(uniques), col_codes))
+        return cls(np.unique(np.stack(codes, axis=1), axis=0,
+                             return_inverse=True)[1].ravel())
+
+    def __call__(self, weights, sample_size, rng=np.random):
+        return self.batch(weights, sample_size, 1, rng)[0]
+
+    def sorted_labels(self, weights):
+        """labels of units sorted by stratum, left over units being labeled
+        by the number of arms, and the labels of left over units"""
+        weights = clean_weights(weights)
+        n_arms = len(weights)
+        floors = np.floor(np.outer(self.counts, weights) + 1e-9).astype(int)
+        block_sizes = np.column_stack(
+            [floors, self.counts - floors.sum(axis=1)])
+        labels = np.repeat(np.tile(np.arange(n_arms + 1), len(self.counts)),
+                           block_sizes.ravel())
+        pool = np.repeat(np.arange(n_arms), arm_targets(
+            weights, len(self.strata)) - floors.sum(axis=0))
+        return labels, pool
+
+    def batch(self, weights, sample_size, size, rng=np.random):
+        if sample_size != len(self.strata):
+            raise ValueError('strata do not match the sample size')
+        labels, pool = self.sorted_labels(weights)
+        left_over = labels == len(clean_weights(weights))
+        uniform = rng.random if isinstance(
+            rng, np.random.Generator) else rng.random_sample
+        keys = uniform((size, sample_size + len(pool)))
+        order = np.argsort(self.strata + keys[:, :sample_size], axis=1)
+        sorted_labels = np.tile(labels, (size, 1))
+        sorted_labels[:, left_over] = pool[
+            np.argsort(keys[:, sample_size:], axis=1)]
+        assignments = np.empty_like(sorted_labels)
+        np.put_along_axis(assignments, order, sorted_labels, axis=1)
+        return assignments.astype(label_dtype(weights))
@@ -3,11 +3,13 @@ import pandas as pd
 import numpy as np
 from numbers import Number
 from itertools import combinations
-from statsmodels.formula.api import ols
 from functools import partial
 
 from .utils import NumericFunction
-from .assignment import get_assignments_as_positions
+from .assignment import get_assignments_as_positions, ArmPositions, \
+    LabelBatch
+from .ingest import CovariateStore, row_chunks, column_means, \
+    column_covariance
 
 
 def identity(x): return x
@@ -21,22 +23,316 @@ max_across_covariates = partial(np.max, axis=1)
 mean_across_covariates = partial(np.mean, axis=1)
 
 
+def skip_missing(values):
+    values = np.asarray(values, dtype=float)
+    return values[~np.isnan(values)]
+
+
+def aggregate_by_draw(aggregator, values, skipna=True, orient=None):
+    """applies `aggregator` to each draw (row) of `values`, passed as a 1d
+    array, or as a single column or row when `orient` is 'column' or 'row',
+    mirroring the single assignment path; missing values are skipped as in
+    pandas reductions unless `skipna` is False"""
+    res = np.empty(len(values))
+    for i, draw_values in enumerate(values):
+        if skipna:
+            draw_values = skip_missing(draw_values)
+        if not draw_values.size:
+            res[i] = np.nan
+            continue
+        if orient == 'column':
+            draw_values = draw_values[:, None]
+        elif orient == 'row':
+            draw_values = draw_values[None, :]
+        res[i] = np.asarray(aggregator(draw_values)).item()
+    return res
+
+
+def arm_masks(assignments, n_arms=None):
+    """(K, N) float mask per arm from a (K, N) matrix of labels, those of a
+    LabelBatch being computed once"""
+    if isinstance(assignments, LabelBatch) and n_arms is None:
+        return iter(assignments.masks)
+    assignments = np.atleast_2d(assignments)
+    return ((assignments == arm).astype(float)
+            for arm in range(n_arms or int(assignments.max()) + 1))
+
+
+def draw_masks(idxs):
+    """(1, N) float masks of a single assignment given as arm indices"""
+    return [np.asarray(idx, dtype=float)[None, :] for idx in idxs]
+
+
+def arm_sums(values, masks, squares=False):
+    """(arms, K, p) arm counts and sums, and sums of squares if `squares`,
+    of `values` for an iterable of (K, N) arm masks, leaving out missing
+    values; `values` are read a chunk of rows at a time"""
+    masks = list(masks)
+    sums = 0.
+    for start, chunk in row_chunks(values):
+        observed = (~np.isnan(chunk)).astype(float)
+        filled = np.where(observed, chunk, 0.)
+        powers = (observed, filled, filled ** 2) if squares else (
+            observed, filled)
+        rows = slice(start, start + len(chunk))
+        sums = sums + np.array([[mask[:, rows] @ power for power in powers]
+                                for mask in masks])
+    return tuple(np.moveaxis(sums, 1, 0))
+
+
+def treatment_pvalues(counts, sums, sq_sums, base_arms):
+    """(arms - 1, K, p) p-values of the treatment dummies in the OLS
+    regression of covariates on a constant and dummies for the arms below
+    the base arm of each draw, computed in closed form from arm moments;
+    entries for arms from the base arm on are missing"""
+    base = np.broadcast_to(
+        np.asarray(base_arms)[None, :, None], (1,) + counts.shape[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+        non_empty = counts > 0
+        ssr = np.sum(np.where(non_empty, sq_sums - sums * means, 0.), axis=0)
+        dof = counts.sum(axis=0) - non_empty.sum(axis=0)
+        base_counts = np.take_along_axis(counts, base, axis=0)[0]
+        base_means = np.take_along_axis(means, base, axis=0)[0]
+        std_err = np.sqrt(ssr / dof * (1 / counts[:-1] + 1 / base_counts))
+        t_stats = (means[:-1] - base_means) / std_err
+    # scipy and statsmodels are imported on first use only, as they make up
+    # most of the import time of the package
+    from scipy.stats import t as student_t
+    pvalues = 2 * student_t.sf(np.abs(t_stats), dof)
+    treatments = np.arange(len(pvalues))[:, None, None]
+    return np.where(treatments < base, pvalues, np.nan)
+
+
+def arm_category_counts(codes, n_categories, assignments, n_arms=None):
+    """(arms, K, categories) counts of category `codes` by arm for a (K, N)
+    matrix of labels, in a single bincount pass; negative codes are left
+    out"""
+    assignments = np.atleast_2d(assignments)
+    n_arms = n_arms or int(assignments.max()) + 1
+    n_draws = len(assignments)
+    draws = np.arange(n_draws)[:, None]
+    observed = codes >= 0
+    bins = ((draws * n_arms + assignments) * n_categories + codes)[:, observed]
+    counts = np.bincount(
+        bins.ravel(), minlength=n_draws * n_arms * n_categories)
+    return counts.reshape(n_draws, n_arms, n_categories).swapaxes(0, 1)
+
+
+class CovariateData:
+    """covariates bound to balance objectives, computing per-dataset state
+    (numeric matrices, whitening factors, category codes) once; covariates
+    in a CovariateStore are read from its memory map"""
+
+    @classmethod
+    def of(cls, df):
+        return df if isinstance(df, cls) else cls(df)
+
+    def __init__(self, df):
+        self.df = df
+        self._cache = {}
+
+    def _cached(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    @property
+    def in_store(self):
+        return isinstance(self.df, CovariateStore)
+
+    @property
+    def numeric_columns(self):
+        """numeric and boolean covariates, those DataFrame.cov reads"""
+        def compute():
+            if self.in_store:
+                return self.df.columns
+            return self.df.select_dtypes(include=['number', 'bool']).columns
+        return self._cached('numeric_columns', compute)
+
+    def values(self, cols):
+        def compute():
+            if self.in_store:
+                return self.df.column_view(cols)
+            return self.df[list(cols)].values.astype(float)
+        return self._cached(('values', tuple(cols)), compute)
+
+    def centered(self, cols):
+        def compute():
+            values = self.values(cols)
+            if self.in_store:
+                return self.df.column_view(cols, column_means(values))
+            return values - np.nanmean(values, axis=0)
+        return self._cached(('centered', tuple(cols)), compute)
+
+    def frame(self, cols):
+        """covariates `cols` as an in-memory DataFrame"""
+        return self.df[list(cols)]
+
+    def whitening(self, cols):
+        """W such that |d @ W| is the Mahalanobis norm of d"""
+        def compute():
+            cov = column_covariance(self.centered(cols)) if self.in_store \
+                else self.df[list(cols)].cov().values
+            return np.linalg.inv(np.linalg.cholesky(cov)).T
+        return self._cached(('whitening', tuple(cols)), compute)
+
+    def codes(self, col):
+        return self._cached(('codes', col), lambda: pd.factorize(
+            self.df[col], sort=True))
+
+
+def shared_arguments(*args):
+    """arguments of balance objectives, covariates being bound to
+    CovariateData and label matrices to LabelBatches, so that objectives of
+    an expression share per-dataset state and arm masks"""
+    return tuple(
+        CovariateData.of(arg) if isinstance(
+            arg, (pd.DataFrame, CovariateStore)) else
+        LabelBatch(arg) if isinstance(arg, np.ndarray) and arg.ndim == 2
+        else arg for arg in args)
+
+
+class SwapBalance:
+    """balance of an assignment, given as a vector of labels, and of the
+    assignments one swap of two units' labels away, scored in batches by
+    `batch_balance`"""
+
+    def __init__(self, batch_balance, labels):
+        self.batch_balance = batch_balance
+        self.labels = np.array(labels, dtype=int)
+
+    @property
+    def balance(self):
+        return self.batch_balance(self.labels[None, :])[0]
+
+    def scores(self, first, second):
+        """balance after swapping units `first[s]` and `second[s]`, for
+        each s"""
+        rows = np.arange(len(first))
+        swapped = np.repeat(self.labels[None, :], len(first), axis=0)
+        swapped[rows, first] = self.labels[second]
+        swapped[rows, second] = self.labels[first]
+        return self.batch_balance(swapped)
+
+    def swap(self, first, second):
+        self.labels[[first, second]] = self.labels[[second, first]]
+
+
+class WhitenedRows:
+    """rows of `values @ whitening`, whitened as they are read so that
+    covariates of a CovariateStore stay on disk"""
+
+    def __init__(self, values, whitening):
+        self.values = values
+        self.whitening = whitening
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, rows):
+        return np.asarray(self.values[rows]) @ self.whitening
+
+
+class MahalanobisSwapBalance(SwapBalance):
+    """Mahalanobis balance under swaps, keeping whitened arm sums so that
+    each swap is scored in O(arms * p) operations"""
+
+    def __init__(self, objective, data, labels):
+        super().__init__(None, labels)
+        cols = objective.col_selection(data)
+        self.aggregator = objective.treatment_aggregator
+        values, whitening = data.values(cols), data.whitening(cols)
+        self.whitened = WhitenedRows(values, whitening) if data.in_store \
+            else values @ whitening
+        n_arms = self.labels.max() + 1
+        self.counts = np.bincount(self.labels, minlength=n_arms)
+        self.sums = 0.
+        for start, chunk in row_chunks(self.whitened):
+            labels = self.labels[start:start + len(chunk)]
+            self.sums = self.sums + np.stack(
+                [chunk[labels == arm].sum(axis=0) for arm in range(n_arms)])
+        self.pairs = tuple(zip(*combinations(range(n_arms), 2)))
+
+    @property
+    def balance(self):
+        return self._balance_of_sums(self.sums[None])[0]
+
+    def scores(self, first, second):
+        rows = np.arange(len(first))
+        delta = self.whitened[second] - self.whitened[first]
+        sums = np.repeat(self.sums[None], len(first), axis=0)
+        sums[rows, self.labels[first]] += delta
+        sums[rows, self.labels[second]] -= delta
+        return self._balance_of_sums(sums)
+
+    def swap(self, first, second):
+        delta = self.whitened[second] - self.whitened[first]
+        self.sums[self.labels[first]] += delta
+        self.sums[self.labels[second]] -= delta
+        super().swap(first, second)
+
+    def _balance_of_sums(self, sums):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / self.counts[None, :, None]
+        first, second = self.pairs
+        sq_dists = np.sum((means[:, first] - means[:, second]) ** 2, axis=2)
+        return -aggregate_by_draw(self.aggregator, sq_dists, orient='column')
+
+
 class BalanceObjective:
 
     def __init__(self, cols=None):
         self._cols = cols
 
     def col_selection(self, df):
-        return self._cols or df.columns
+        if self._cols:
+            return self._cols
+        data = CovariateData.of(df)
+        return data.numeric_columns if self.numeric_only else data.df.columns
 
     @property
     def balance_func(self):
-        return NumericFunction.numerize(self._balance_func)
+        return NumericFunction.numerize(
+            self._balance_func, self._batch_balance_func, self.prepare,
+            self.share_func, self.swap_balance)
+
+    def prepare(self, df):
+        """binds the objective to the covariates in `df` and returns a
+        NumericFunction of assignments only"""
+        data = CovariateData.of(df) if self.uses_covariate_data else df
+        batch_func = None if self._batch_balance_func is None else partial(
+            self._batch_balance_func, data)
+        return NumericFunction(partial(self._balance_func, data), batch_func,
+                               share_func=self.share_func)
+
+    # objectives defaulting to the numeric covariates only, as
+    # DataFrame.cov does
+    numeric_only = False
+
+    # objectives accepting `CovariateData` in place of a DataFrame, and
+    # LabelBatch in place of label matrices, so that `prepare` computes
+    # their per-dataset state once and expressions share it
+    uses_covariate_data = False
+
+    @property
+    def share_func(self):
+        return shared_arguments if self.uses_covariate_data else None
 
     @abc.abstractmethod
     def _balance_func(self, df, assignments):
         """"""
 
+    # objectives supporting batched evaluation implement
+    # `_batch_balance_func(df, assignments)`, taking a (K, N) matrix of arm
+    # labels and returning the K scalar balance scores at once
+    _batch_balance_func = None
+
+    def swap_balance(self, df, labels):
+        """SwapBalance updating balance incrementally under unit swaps, or
+        None if the objective has none"""
+        return None
+
     @classmethod
     def assignment_indices(cls, df, assignments):
         idxs = cls._idxs_from_assignment(df, assignments)
@@ -44,6 +340,9 @@ class BalanceObjective:
 
     @classmethod
     def _idxs_from_assignment(cls, df, assignments):
+        if isinstance(assignments, ArmPositions) and \
+                len(assignments.labels) == len(df.index):
+            return assignments.masks
         if len(assignments[0]) == len(df.index):
             return assignments
         else:
@@ -51,7 +350,8 @@ class BalanceObjective:
 
     @classmethod
     def _append_complementary_assignment(cls, idxs):
-        total_assignments = np.add(*idxs) if len(idxs) > 1 else idxs[0]
+        idxs = list(idxs)
+        total_assignments = np.sum(idxs, axis=0)
         if not min(total_assignments):
             idxs.append(np.logical_not(total_assignments))
         return idxs
@@ -62,18 +362,41 @@ class MahalanobisBalance(BalanceObjective):
         self.treatment_aggregator = treatment_aggregator
         super().__init__(cols)
 
+    numeric_only = True
+    uses_covariate_data = True
+
     def _balance_func(self, df, assignments):
-        df_sel = df[self.col_selection(df)]
-        inverse_cov = np.linalg.inv(df_sel.cov())
-        means = [df_sel.loc[idx].mean() for idx in
-                 self.assignment_indices(df_sel, assignments)]
-        combs = list(combinations(range(len(means)), 2))
-        mean_diffs = [means[a] - means[b] for a, b in combs]
-        res = pd.DataFrame(data=[mean_diff @ inverse_cov @ mean_diff
-                                 for mean_diff in mean_diffs],
+        data = CovariateData.of(df)
+        masks = draw_masks(self.assignment_indices(data.df, assignments))
+        sq_dists, combs = self.squared_distances(data, masks)
+        res = pd.DataFrame(data=sq_dists[0],
                            index=['{}-{}'.format(a, b) for a, b in combs])
         return -self.treatment_aggregator(res)
 
+    def _batch_balance_func(self, df, assignments):
+        sq_dists, _ = self.squared_distances(
+            CovariateData.of(df), arm_masks(assignments))
+        return -aggregate_by_draw(
+            self.treatment_aggregator, sq_dists, orient='column')
+
+    def swap_balance(self, df, labels):
+        data = CovariateData.of(df)
+        if np.isnan(np.asarray(data.values(
+                self.col_selection(data)))).any():
+            return None
+        return MahalanobisSwapBalance(self, data, labels)
+
+    def squared_distances(self, data, masks):
+        cols = self.col_selection(data)
+        counts, sums = arm_sums(data.values(cols), masks)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            whitened_means = (sums / counts) @ data.whitening(cols)
+        combs = list(combinations(range(len(whitened_means)), 2))
+        sq_dists = np.stack([np.sum(
+            (whitened_means[a] - whitened_means[b]) ** 2, axis=1)
+            for a, b in combs], axis=1)
+        return sq_dists, combs
+
 
 def mahalanobis_balance(cols=None):
     return MahalanobisBalance(np.max, cols=cols).balance_func
@@ -86,14 +409,48 @@ class PValueBalance(BalanceObjective):
         self.covariate_aggregator = covariate_aggregator
         super().__init__(cols)
 
+    numeric_only = True
+    uses_covariate_data = True
+
     def _balance_func(self, df, assignments):
-        pvalues = dict((col, self.pvalues_by_col(
-            col, df, assignments)) for col in self.col_selection(df))
+        data = CovariateData.of(df)
+        cols = self.col_selection(data)
+        idxs = self.assignment_indices(data.df, assignments)
+        if np.max(np.sum(idxs, axis=0)) > 1:
+            df = data.frame(cols)
+            pvalues = dict((col, self.pvalues_by_col(
+                col, df, assignments)) for col in cols)
+        else:
+            pvalues = self.treatment_pvalues(
+                data, draw_masks(idxs), [len(idxs) - 1])
+            pvalues = dict((col, self._aggregate_treatments(pv))
+                           for col, pv in zip(cols, pvalues[:, 0].T))
         return self.covariate_aggregator(pd.DataFrame(pvalues))
 
+    def _batch_balance_func(self, df, assignments):
+        base_arms = np.atleast_2d(assignments).max(axis=1)
+        pvalues = self.treatment_pvalues(
+            CovariateData.of(df), arm_masks(assignments), base_arms)
+        pvalues_by_col = np.empty(pvalues.shape[1:])
+        for n_treatments in np.unique(base_arms):
+            sel = base_arms == n_treatments
+            pvalues_by_col[sel] = np.stack([aggregate_by_draw(
+                self.treatment_aggregator, pv[:n_treatments].T, skipna=False)
+                for pv in np.moveaxis(pvalues[:, sel], 2, 0)], axis=1)
+        return aggregate_by_draw(
+            self.covariate_aggregator, pvalues_by_col, orient='row')
+
+    def treatment_pvalues(self, data, masks, base_arms):
+        values = data.centered(self.col_selection(data))
+        return treatment_pvalues(
+            *arm_sums(values, masks, squares=True), base_arms)
+
     def pvalues_by_col(self, col, df, assignments):
-        pv = self.treatment_aggregator(self.ols_col_on_treatment(
+        return self._aggregate_treatments(self.ols_col_on_treatment(
             col, df, assignments).pvalues.iloc[1:].values)
+
+    def _aggregate_treatments(self, pvalues):
+        pv = self.treatment_aggregator(pvalues)
         if isinstance(pv, Number):
             pv = [pv]
         return pv
@@ -105,6 +462,7 @@ class PValueBalance(BalanceObjective):
         data = pd.concat((df, t_dummies), axis=1)
         sel_dummies = self._get_non_collinear_dummies(t_dummies)
         formula = '{} ~ 1 + {}'.format(col, ' + '.join(sel_dummies))
+        from statsmodels.formula.api import ols
         return ols(formula, data=data).fit()
 
     def _get_non_collinear_dummies(self, t_dummies):
@@ -142,9 +500,12 @@ class BlockBalance(BalanceObjective):
         self.category_aggregator = category_aggregator
         super().__init__(cols)
 
+    uses_covariate_data = True
+
     def _balance_func(self, df, assignments):
+        data = CovariateData.of(df)
         relative_count_all = dict((col, self.relative_count_by_col(
-            col, df, assignments)) for col in self.col_selection(df))
+            col, data, assignments)) for col in self.col_selection(data))
         return -self.covariate_aggregator(pd.DataFrame(relative_count_all))
 
     def relative_count_by_col(self, col, df, assignments):
@@ -155,12 +516,38 @@ class BlockBalance(BalanceObjective):
         return [res] if isinstance(res, Number) else res
 
     def count_by_col(self, col, df, assignments):
-        cat = sorted(list(set(df[col])))
-        idxs = self.assignment_indices(df, assignments)
-        count = [[sum(df[col].loc[idx].eq(v)) for v in cat] for idx in idxs]
+        data = CovariateData.of(df)
+        codes, cat = data.codes(col)
+        idxs = self.assignment_indices(data.df, assignments)
+        count = [np.bincount(codes[np.asarray(idx, dtype=bool) & (codes >= 0)],
+                             minlength=len(cat)) for idx in idxs]
         return pd.DataFrame(data=count, columns=cat,
                             index=['t{}'.format(i) for i in range(len(idxs))])
 
+    def _batch_balance_func(self, df, assignments):
+        data = CovariateData.of(df)
+        assignments = np.atleast_2d(assignments)
+        base_arms = assignments.max(axis=1)
+        cols = self.col_selection(data)
+        relative_counts = np.empty((len(assignments), len(cols)))
+        for j, col in enumerate(cols):
+            codes, cat = data.codes(col)
+            counts = arm_category_counts(codes, len(cat), assignments)
+            for base_arm in np.unique(base_arms):
+                sel = base_arms == base_arm
+                relative_counts[sel, j] = self._batch_relative_count(
+                    counts[:int(base_arm) + 1, sel])
+        return -aggregate_by_draw(
+            self.covariate_aggregator, relative_counts, orient='row')
+
+    def _batch_relative_count(self, counts):
+        median = np.median(counts, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative_dev = (counts - median) / median
+        by_arm = np.stack([aggregate_by_draw(self.category_aggregator, dev)
+                           for dev in relative_dev], axis=1)
+        return aggregate_by_draw(self.treatment_aggregator, by_arm)
+
 
 def block_balance(cols=None):
     return BlockBalance(
@@ -0,0 +1,195 @@
+"""offline timing and peak memory benchmarks of designs and objectives on
+synthetic covariates.
+
+Each grid varies one of sample size N, number of covariates p, number of
+draws k, number of arms and draw scheme at a time around a base case, for
+every design and objective. Results are saved as json, by default under
+benchmarks/results/<commit>.json, and two result files can be compared:
+
+    python -m rct.benchmarks run --grid quick
+    python -m rct.benchmarks compare old.json new.json
+"""
+from os import path
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from ..design import RCT, KRerandomizedRCT, QuantileTargetingRCT
+from ..balance import mahalanobis_balance, pvalue_balance, block_balance
+
+RESULTS_DIR = path.join(path.dirname(__file__), 'results')
+NUM_CATEGORIES = 5
+QUANTILE_TARGET = .05
+
+BASE_CASE = dict(n=1000, p=10, k=1000, arms=2, scheme='shuffled')
+GRIDS = {
+    'quick': dict(n=[100, 1000, 10000], p=[2, 10, 50], k=[100, 1000],
+                  arms=[2, 3], scheme=['iid', 'shuffled']),
+    'full': dict(n=[100, 1000, 10000, 100000, 1000000],
+                 p=[2, 10, 50, 200], k=[100, 1000, 10000, 100000, 1000000],
+                 arms=[2, 3, 5, 10], scheme=['iid', 'shuffled']),
+}
+DESIGNS = ['rct', 'krct', 'qrct']
+OBJECTIVES = ['mahalanobis', 'pvalue', 'block', 'mixed']
+CASE_KEYS = ['design', 'objective', 'n', 'p', 'k', 'arms', 'scheme']
+
+
+def synthetic_covariates(n, p, seed=0):
+    """p - 1 standard normal covariates x0, x1, ... and a categorical
+    covariate `cat`"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.standard_normal((n, p - 1)),
+                      columns=['x{}'.format(i) for i in range(p - 1)])
+    df['cat'] = rng.integers(NUM_CATEGORIES, size=n)
+    return df
+
+
+def make_objective(name, df):
+    numeric = [col for col in df.columns if col != 'cat']
+    if name == 'mahalanobis':
+        return mahalanobis_balance(numeric)
+    if name == 'pvalue':
+        return pvalue_balance(numeric)
+    if name == 'block':
+        return block_balance(['cat'])
+    return mahalanobis_balance(numeric) + pvalue_balance(numeric) \
+        - block_balance(['cat'])
+
+
+def make_design(case, df):
+    weights = [1. / case['arms']] * case['arms']
+    if case['design'] == 'rct':
+        return RCT(df, weights)
+    objective = make_objective(case['objective'], df)
+    if case['design'] == 'krct':
+        return KRerandomizedRCT(objective, df, weights, k=case['k'])
+    return QuantileTargetingRCT(objective, df, weights, QUANTILE_TARGET,
+                                num_monte_carlo=case['k'])
+
+
+def cases(grid):
+    """base case, then cases varying one parameter of `grid` at a time, for
+    each design and objective; plain RCTs ignore objectives and k"""
+    res = []
+    for design in DESIGNS:
+        for objective in ([None] if design == 'rct' else OBJECTIVES):
+            base = dict(BASE_CASE, design=design, objective=objective)
+            design_cases = [base]
+            for key, values in grid.items():
+                if design == 'rct' and key in ('p', 'k'):
+                    continue
+                design_cases += [dict(base, **{key: value})
+                                 for value in values if value != base[key]]
+            res += design_cases
+    return res
+
+
+def draw(case, df):
+    design = make_design(case, df)
+    return getattr(design, 'assignment_from_{}'.format(case['scheme']))
+
+
+def run_case(case):
+    """case with the wall time in seconds and the peak traced memory in MB
+    of drawing its assignment, covariate generation excluded; memory is
+    traced in a second run, as tracing slows allocations down"""
+    df = synthetic_covariates(case['n'], case['p'])
+    start = time.perf_counter()
+    draw(case, df)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    draw(case, df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(case, seconds=seconds, peak_mb=peak / 2 ** 20)
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=path.dirname(__file__), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(grid='quick', output=None, verbose=True):
+    """runs all cases of `grid` and saves their results to `output`"""
+    commit = current_commit()
+    results = []
+    for case in cases(GRIDS[grid]):
+        results.append(run_case(case))
+        if verbose:
+            print(format_result(results[-1]), flush=True)
+    report = dict(commit=commit, grid=grid,
+                  date=datetime.datetime.now().isoformat(),
+                  python=platform.python_version(), numpy=np.__version__,
+                  pandas=pd.__version__, results=results)
+    output = output or path.join(RESULTS_DIR, '{}.json'.format(commit))
+    os.makedirs(path.dirname(path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fh:
+        json.dump(report, fh, indent=1)
+    return report
+
+
+def case_key(result):
+    return tuple(result[key] for key in CASE_KEYS)
+
+
+def format_result(result):
+    return '{:<44} {:>10.3f}s {:>10.1f}MB'.format(
+        ' '.join(str(result[key]) for key in CASE_KEYS),
+        result['seconds'], result['peak_mb'])
+
+
+def compare(old, new, tolerance=1.2):
+    """(case, time ratio, memory ratio) of cases of report `new` also in
+    report `old`, and the list of those slower or larger by more than
+    `tolerance`"""
+    old_results = dict((case_key(res), res) for res in old['results'])
+    ratios, regressions = [], []
+    for res in new['results']:
+        before = old_results.get(case_key(res))
+        if before is None:
+            continue
+        ratio = (res['seconds'] / before['seconds'],
+                 res['peak_mb'] / max(before['peak_mb'], 1e-6))
+        ratios.append((case_key(res),) + ratio)
+        if max(ratio) > tolerance:
+            regressions.append(ratios[-1])
+    return ratios, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m rct.benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run a benchmark grid')
+    run_parser.add_argument('--grid', choices=sorted(GRIDS), default='quick')
+    run_parser.add_argument('--output', help='json file for results')
+    compare_parser = commands.add_parser(
+        'compare', help='compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--tolerance', type=float, default=1.2)
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args.grid, args.output)
+        return 0
+    with open(args.old) as old, open(args.new) as new:
+        ratios, regressions = compare(
+            json.load(old), json.load(new), args.tolerance)
+    for key, time_ratio, memory_ratio in ratios:
+        print('{:<44} time x{:.2f} memory x{:.2f}{}'.format(
+            ' '.join(str(k) for k in key), time_ratio, memory_ratio,
+            '  <- regression' if max(time_ratio, memory_ratio) >
+            args.tolerance else ''))
+    return 1 if regressions else 0
@@ -0,0 +1,156 @@
+from collections import OrderedDict
+from functools import partial
+from hashlib import md5
+import os
+import tempfile
+import types
+
+import numpy as np
+import pandas as pd
+
+from .ingest import CovariateStore, row_chunks
+
+
+def fingerprint(obj):
+    """md5 hex digest of `obj` stable across sessions: functions are
+    described by their name and code, objects by their class and
+    attributes, arrays and frames by their contents"""
+    return md5(repr(_state(obj, set())).encode()).hexdigest()
+
+
+def _digest(chunks):
+    hasher = md5()
+    for chunk in chunks:
+        hasher.update(np.ascontiguousarray(chunk).tobytes())
+    return hasher.hexdigest()
+
+
+def _name(obj):
+    return '{}.{}'.format(getattr(obj, '__module__', None),
+                          getattr(obj, '__qualname__', type(obj).__name__))
+
+
+def _code_state(code):
+    return (code.co_code, tuple(
+        _code_state(const) if isinstance(const, types.CodeType) else
+        repr(const) for const in code.co_consts), code.co_names)
+
+
+def _state(obj, seen):
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        return obj
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return 'ndarray', str(obj.dtype), obj.shape, _digest([obj])
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        names = obj.columns if isinstance(obj, pd.DataFrame) else [obj.name]
+        return (type(obj).__name__, _state(list(names), seen), _digest(
+            [pd.util.hash_pandas_object(obj, index=True).values]))
+    if isinstance(obj, CovariateStore):
+        return ('CovariateStore', list(obj.columns), obj.hash_int or _digest(
+            chunk for _, chunk in row_chunks(obj.array)))
+    if isinstance(obj, (type, types.ModuleType)) or callable(obj) and \
+            hasattr(obj, '__qualname__') and not isinstance(
+                obj, (types.FunctionType, types.MethodType)):
+        return _name(obj)
+    if id(obj) in seen:
+        return 'cycle', _name(type(obj))
+    seen = seen | {id(obj)}
+    if isinstance(obj, (list, tuple)):
+        return type(obj).__name__, tuple(_state(x, seen) for x in obj)
+    if isinstance(obj, dict):
+        return 'dict', tuple(sorted(
+            (repr(key), _state(value, seen)) for key, value in obj.items()))
+    if isinstance(obj, partial):
+        return ('partial', _state(obj.func, seen), _state(obj.args, seen),
+                _state(obj.keywords, seen))
+    if isinstance(obj, types.MethodType):
+        return 'method', obj.__func__.__qualname__, _state(obj.__self__, seen)
+    if isinstance(obj, types.FunctionType):
+        cells = [cell.cell_contents for cell in obj.__closure__ or ()]
+        return ('function', _name(obj), _code_state(obj.__code__),
+                _state(obj.__defaults__, seen), _state(cells, seen))
+    if hasattr(obj, '__dict__'):
+        return _name(type(obj)), _state(vars(obj), seen)
+    return _name(type(obj)), repr(obj)
+
+
+class ResultCache:
+    """design results, dicts of arrays keyed by strings, kept in memory up
+    to `max_memory_bytes` and, if `directory` is set, saved there as npz
+    files up to `max_bytes`; least recently used results are evicted
+    first. Score vectors are left out unless `store_scores`."""
+
+    def __init__(self, directory=None, max_bytes=2 ** 30,
+                 max_memory_bytes=2 ** 28, store_scores=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.store_scores = store_scores
+        self._memory = OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, '{}.npz'.format(key))
+
+    def get(self, key):
+        """result saved under `key`, or None"""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if self.directory is None or not os.path.exists(self.path(key)):
+            return None
+        with np.load(self.path(key)) as saved:
+            result = dict(saved)
+        os.utime(self.path(key))
+        self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        result = dict((name, np.asarray(value))
+                      for name, value in result.items() if value is not None)
+        self._remember(key, result)
+        if self.directory is not None:
+            fd, temp_path = tempfile.mkstemp(suffix='.npz',
+                                             dir=self.directory)
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez(fh, **result)
+            os.replace(temp_path, self.path(key))
+            self._evict_files()
+
+    def clear(self):
+        self._memory.clear()
+        for file_path, _, _ in self._files():
+            os.remove(file_path)
+
+    def _remember(self, key, result):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        sizes = [sum(a.nbytes for a in res.values())
+                 for res in self._memory.values()]
+        total = sum(sizes)
+        for size in sizes:
+            if total <= self.max_memory_bytes or len(self._memory) == 1:
+                break
+            self._memory.popitem(last=False)
+            total -= size
+
+    def _files(self):
+        """(path, last use, size) of saved results"""
+        if self.directory is None:
+            return []
+        paths = [os.path.join(self.directory, name)
+                 for name in os.listdir(self.directory)
+                 if name.endswith('.npz')]
+        return [(p, os.stat(p).st_mtime, os.stat(p).st_size) for p in paths]
+
+    def _evict_files(self):
+        files = sorted(self._files(), key=lambda f: f[1])
+        total = sum(size for _, _, size in files)
+        for file_path, _, size in files[:-1]:
+            if total <= self.max_bytes:
+                break
+            os.remove(file_path)
+            total -= size
@@ -0,0 +1,175 @@
+"""command line assignment of covariate files, or of each covariate file of
+a directory, writing for each file its assignment, a p-values balance
+report and timing stats:
+
+    python -m rct assign covariates.csv --design krct --weights .5 .5 \\
+        -k 1000 --objective 'mahalanobis:A,B - block:C' --output out
+
+Files of a directory are assigned by a single pool of `--n-jobs` worker
+processes kept for the whole run, so that imports and objective state are
+paid for once; a single file runs the draws of k-rerandomized designs on
+`--n-jobs` processes instead. Results do not depend on `--n-jobs`.
+
+Objectives are sums of terms `[weight *] name[:col,col...]`, where name is
+one of `mahalanobis`, `pvalue` or `block` and columns default to all
+covariates; terms are separated by `+` or `-`.
+"""
+from os import path
+from functools import partial
+import argparse
+import json
+import multiprocessing as mp
+import os
+import re
+import time
+
+from .balance import mahalanobis_balance, pvalue_balance, block_balance, \
+    pvalues_report
+from .design import RCT, KRerandomizedRCT, QuantileTargetingRCT
+from .ingest import BINARY_READERS
+
+OBJECTIVES = dict(mahalanobis=mahalanobis_balance, pvalue=pvalue_balance,
+                  block=block_balance)
+DESIGNS = ['rct', 'krct', 'qrct']
+COVARIATE_EXTENSIONS = ['.csv'] + sorted(BINARY_READERS)
+OUTPUT_CHUNK_ROWS = 2 ** 16
+_TERM = re.compile(r'\s*([+-]?)\s*(?:([0-9.]+(?:[eE][+-]?[0-9]+)?)\s*\*)?'
+                   r'\s*(\w+)(?::([^+\-*]+))?\s*')
+
+
+def parse_objective(spec):
+    """(objective, columns) of an objective spec, columns being None when
+    some term uses all covariates"""
+    objective, columns, position = None, [], 0
+    while position < len(spec):
+        match = _TERM.match(spec, position)
+        if match is None or match.end() == position:
+            raise ValueError('invalid objective: {}'.format(spec))
+        sign, weight, name, cols = match.groups()
+        if name not in OBJECTIVES or (objective is not None and not sign):
+            raise ValueError('invalid objective: {}'.format(spec))
+        cols = None if cols is None else \
+            [col.strip() for col in cols.split(',')]
+        term = OBJECTIVES[name](cols)
+        if weight is not None:
+            term = float(weight) * term
+        if objective is None:
+            objective = -term if sign == '-' else term
+        else:
+            objective = objective - term if sign == '-' else objective + term
+        columns = None if columns is None or cols is None else \
+            columns + [col for col in cols if col not in columns]
+        position = match.end()
+    if objective is None:
+        raise ValueError('empty objective')
+    return objective, columns
+
+
+def make_design(file_path, args, n_jobs=None):
+    if args.design == 'rct':
+        return RCT(file_path, args.weights, args.seed)
+    objective, columns = parse_objective(args.objective)
+    if args.design == 'krct':
+        design = KRerandomizedRCT(
+            objective, file_path, args.weights, args.k, args.seed,
+            n_jobs=n_jobs or 1, columns=columns, strata=args.strata)
+    else:
+        design = QuantileTargetingRCT(
+            objective, file_path, args.weights, args.quantile, args.seed,
+            num_monte_carlo=args.k, columns=columns, strata=args.strata)
+    return design.instrument()
+
+
+def output_paths(file_path, output):
+    stem = path.join(output, path.splitext(path.basename(file_path))[0])
+    return dict((name, '{}.{}'.format(stem, name))
+                for name in ['assignment.csv', 'balance.csv', 'stats.json'])
+
+
+def assign(file_path, args, n_jobs=None):
+    """assigns `file_path` and writes its outputs under `args.output`;
+    returns their paths and the wall time of the run"""
+    start = time.perf_counter()
+    design = make_design(file_path, args, n_jobs)
+    assignment = getattr(design, 'assignment_from_{}'.format(args.scheme))
+    report = pvalues_report(design.df, assignment)
+    seconds = time.perf_counter() - start
+    paths = output_paths(file_path, args.output)
+    assignment.to_csv(paths['assignment.csv'], chunksize=OUTPUT_CHUNK_ROWS)
+    report.to_csv(paths['balance.csv'])
+    with open(paths['stats.json'], 'w') as fh:
+        json.dump(dict(file=file_path, seconds=seconds, seed=design.seed,
+                       **assignment.attrs.get('stats', {})), fh, indent=1)
+    return dict(file=file_path, seconds=seconds, outputs=paths)
+
+
+def _assign_on_worker(args, file_path):
+    return assign(file_path, args)
+
+
+def covariate_files(input_path):
+    if not path.isdir(input_path):
+        return [input_path]
+    return sorted(
+        path.join(input_path, name) for name in os.listdir(input_path)
+        if path.splitext(name)[1].lower() in COVARIATE_EXTENSIONS)
+
+
+def assign_all(input_path, args):
+    """yields the results of `assign` for each covariate file of
+    `input_path` as they complete"""
+    file_paths = covariate_files(input_path)
+    os.makedirs(args.output, exist_ok=True)
+    if len(file_paths) == 1 or args.n_jobs == 1:
+        for file_path in file_paths:
+            yield assign(file_path, args, args.n_jobs)
+        return
+    processes = None if args.n_jobs == -1 else args.n_jobs
+    with mp.Pool(processes) as pool:
+        for result in pool.imap_unordered(
+                partial(_assign_on_worker, args), file_paths):
+            yield result
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='python -m rct')
+    commands = parser.add_subparsers(dest='command', required=True)
+    assign_parser = commands.add_parser(
+        'assign', help='assign a covariate file or directory of files')
+    assign_parser.add_argument('input', help='covariate file or directory')
+    assign_parser.add_argument('--design', choices=DESIGNS, default='krct')
+    assign_parser.add_argument('--weights', type=float, nargs='+',
+                               default=[.5, .5])
+    assign_parser.add_argument('-k', type=int, default=1000,
+                               help='number of draws')
+    assign_parser.add_argument('--quantile', type=float, default=.05,
+                               help='quantile target of qrct designs')
+    assign_parser.add_argument('--objective', default='mahalanobis')
+    assign_parser.add_argument('--scheme', default='iid',
+                               choices=['iid', 'shuffled', 'stratified'])
+    assign_parser.add_argument('--strata', nargs='+',
+                               help='categorical covariates of strata')
+    assign_parser.add_argument('--seed', type=int, default=0)
+    assign_parser.add_argument('--n-jobs', type=int, default=1)
+    assign_parser.add_argument('--output', default='.',
+                               help='directory of output files')
+    return parser
+
+
+def assign_options(**options):
+    """`assign` options, those not given taking their command line
+    defaults"""
+    args = make_parser().parse_args(['assign', ''])
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise ValueError('unknown option: {}'.format(name))
+        setattr(args, name, value)
+    return args
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    for result in assign_all(args.input, args):
+        print('{:<40} {:>10.3f}s'.format(result['file'], result['seconds']),
+              flush=True)
+    return 0
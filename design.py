@@ -1,4 +1,6 @@
-from hashlib import md5
+from itertools import islice
+from functools import partial, reduce
+from operator import itemgetter
 import random
 import abc
 
@@ -7,31 +9,38 @@ import pandas as pd
 import numpy as np
 
 from .assignment import draw_iid_assignment, draw_shuffled_assignment, \
-    get_assignments_as_positions
-from .balance import BalanceObjective
-from .utils import QuantileTarget
+    get_assignments_as_positions, draw_rng, draw_iid_assignments, \
+    label_dtype, StratifiedDraw
+from .ingest import read_covariates, CovariateStore
+from .cache import fingerprint
+from .balance import BalanceObjective, CovariateData, SwapBalance
+from .utils import QuantileTarget, NumericFunction, map_on_workers, \
+    RunStats, NO_STATS
+
+MAX_BATCH_ELEMENTS = 2 ** 22
+DRAWS_PER_STREAM = 1024
+DRAW_SCHEMES = dict(iid=draw_iid_assignment, shuffled=draw_shuffled_assignment)
 
 
 class RCTBase:
-    def __init__(self, file_path_or_frame, weights, seed=0):
+    def __init__(self, file_path_or_frame, weights, seed=0, legacy_rng=True,
+                 columns=None):
         self.weights = weights
         self.shift_seed = seed
-        if isinstance(file_path_or_frame, pd.DataFrame):
+        self.legacy_rng = legacy_rng
+        if isinstance(file_path_or_frame, CovariateStore):
+            self.file_path = None
+            self.df = file_path_or_frame
+            self.file_hash_int = file_path_or_frame.hash_int
+        elif isinstance(file_path_or_frame, pd.DataFrame):
             self.file_path = None
-            self.df = file_path_or_frame.copy()
+            self.df = file_path_or_frame.copy() if columns is None else \
+                file_path_or_frame[list(columns)].copy()
+            self.file_hash_int = 0
         else:
             self.file_path = file_path_or_frame
-            self.df = pd.read_csv(file_path_or_frame)
-
-    @lazy_property.LazyProperty
-    def file_hash_int(self):
-        if self.file_path is None:
-            return 0
-        hasher = md5()
-        with open(self.file_path, 'rb') as fh:
-            buf = fh.read()
-            hasher.update(buf)
-        return int(hasher.hexdigest(), 16)
+            self.df, hasher = read_covariates(file_path_or_frame, columns)
+            self.file_hash_int = int(hasher.hexdigest(), 16)
 
     @lazy_property.LazyProperty
     def seed(self):
@@ -55,34 +64,93 @@ class RCTBase:
         return self.as_frame(
             draw_shuffled_assignment(self.weights, self.sample_size))
 
+    def draw(self, draw_fun, index):
+        """assignment number `index` of the design, generated on its own
+        from the design seed and `index`"""
+        return draw_fun(self.weights, self.sample_size,
+                        draw_rng(self.seed, index))
+
     @property
     def sample_size(self):
         return len(self.df)
 
     def as_frame(self, assignment):
-        return pd.DataFrame(
+        frame = pd.DataFrame(
             data=assignment, index=self.df.index, columns=['t'])
+        stats = getattr(self, 'stats', NO_STATS)
+        if stats.enabled:
+            frame.attrs['stats'] = stats.as_dict()
+        return frame
 
 
 class RCT(RCTBase):
 
     @property
     def assignment_from_iid(self):
+        if not self.legacy_rng:
+            return self.as_frame(self.draw(draw_iid_assignment, 0))
         np.random.seed(self.seed)
         return self._draw_iid_assignment()
 
     @property
     def assignment_from_shuffled(self):
+        if not self.legacy_rng:
+            return self.as_frame(self.draw(draw_shuffled_assignment, 0))
         random.seed(self.seed)
         return self._draw_shuffled_assignment()
 
 
+class BalanceDistribution:
+    """balance scores of the candidate draws of a design run, in draw
+    order, and the balance of the assignment selected, candidate number
+    `selected_draw` if known"""
+    QUANTILES = [0, .01, .05, .25, .5, .75, .95, .99, 1]
+
+    def __init__(self, scores, selected, selected_draw=None):
+        self.scores = np.asarray(scores, dtype=float)
+        self.selected_draw = selected_draw
+        self.selected = selected if selected_draw is None else \
+            self.scores[selected_draw]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.scores, dtype=dtype)
+
+    def __len__(self):
+        return len(self.scores)
+
+    @property
+    def rank(self):
+        """rank of the selected assignment among candidates, 1 being the
+        best balanced, ties being broken in its favor; missing scores rank
+        last. Without `selected_draw`, scores equal to the selected balance
+        up to relative rounding errors count as ties."""
+        scores = np.nan_to_num(self.scores, nan=-np.inf)
+        above = scores > self.selected
+        if self.selected_draw is None:
+            above &= ~np.isclose(scores, self.selected, rtol=1e-9, atol=0)
+        return 1 + int(np.sum(above))
+
+    def quantiles(self, q=None):
+        q = self.QUANTILES if q is None else q
+        return pd.Series(np.nanquantile(self.scores, q), index=q)
+
+
 class BalancedRCTBase(RCTBase):
-    def __init__(self, objective, file_path_or_frame, weights, k=None, seed=0):
-        super().__init__(file_path_or_frame, weights, seed)
+    """rerandomized designs; with `strata`, a list of categorical
+    covariates, `assignment_from_stratified` draws candidates assigned
+    within strata"""
+
+    def __init__(self, objective, file_path_or_frame, weights, k=None, seed=0,
+                 legacy_rng=True, columns=None, strata=None):
+        if columns is not None and strata is not None:
+            columns = list(columns) + [
+                col for col in strata if col not in columns]
+        super().__init__(file_path_or_frame, weights, seed, legacy_rng,
+                         columns)
         self._balance = objective.balance_func \
             if isinstance(objective, BalanceObjective) else objective
         self._k = k
+        self.strata = strata
 
     @property
     def k(self):
@@ -90,58 +158,701 @@ class BalancedRCTBase(RCTBase):
             self._k = self.sample_size
         return self._k
 
+    @property
+    def assignment_from_iid(self):
+        return self.assignment(draw_iid_assignment)
+
+    @property
+    def assignment_from_shuffled(self):
+        return self.assignment(draw_shuffled_assignment)
+
+    @property
+    def assignment_from_stratified(self):
+        return self.assignment(self.stratified_draw)
+
+    @lazy_property.LazyProperty
+    def stratified_draw(self):
+        if self.strata is None:
+            raise ValueError('stratified draws require strata')
+        return StratifiedDraw.from_frame(self.df, self.strata)
+
+    def draw_scheme(self, scheme):
+        """draw function of `scheme`, 'iid', 'shuffled' or 'stratified'"""
+        if scheme == 'stratified':
+            return self.stratified_draw
+        return DRAW_SCHEMES[scheme]
+
+    @abc.abstractmethod
+    def select_assignment(self, draw_fun):
+        """assignment selected among draws of `draw_fun`"""
+
+    stats = NO_STATS
+    cache = None
+    # position of the assignment selected by `select_assignment` among
+    # candidate scores, if known
+    selected_draw = None
+    # attributes of the design set by `select_assignment` and saved along
+    # with cached assignments; the score vector is saved if the cache
+    # stores scores
+    score_attribute = None
+    result_attributes = ()
+
+    def assignment(self, draw_fun):
+        """selected assignment, looked up in and saved to `cache` if set"""
+        if self.cache is None:
+            return self.select_assignment(draw_fun)
+        key = self.cache_key(draw_fun)
+        with self.stats.timer('cache'):
+            result = self.cache.get(key)
+        if result is not None:
+            self.stats.count('cache_hits')
+            for name in self._cached_attributes():
+                value = result.get(name)
+                setattr(self, name, value if value is None or value.ndim
+                        else value.item())
+            return self.as_frame(result['assignment'])
+        assignment = self.select_assignment(draw_fun)
+        result = dict((name, getattr(self, name))
+                      for name in self._cached_attributes())
+        with self.stats.timer('cache'):
+            self.cache.put(key, dict(result, assignment=assignment.t.values))
+        return assignment
+
+    def _cached_attributes(self):
+        names = list(self.result_attributes) + ['selected_draw']
+        if self.cache.store_scores and self.score_attribute is not None:
+            names.append(self.score_attribute)
+        return names
+
+    def balance_distribution(self, scheme='iid'):
+        """BalanceDistribution of the candidates drawn by `scheme`, and of
+        the assignment selected among them"""
+        draw_fun = self.draw_scheme(scheme)
+        assignment = self.assignment(draw_fun)
+        if self.score_attribute is None:
+            scores = self.candidate_scores(draw_fun)
+        else:
+            if getattr(self, self.score_attribute) is None:
+                self.select_assignment(draw_fun)
+            scores = getattr(self, self.score_attribute)
+        return BalanceDistribution(scores, self.balance(assignment.t.values),
+                                   self.selected_draw)
+
+    def candidate_scores(self, draw_fun):
+        """balance of the `k` candidate assignments, scored in batches if
+        the objective allows"""
+        if self.supports_batch:
+            return np.concatenate([self.batch_balance(batch)
+                                   for batch in self.draw_batches(draw_fun)])
+        return np.fromiter(map(self.balance, self.draws(draw_fun)), float,
+                           self.k)
+
+    def use_cache(self, cache):
+        """looks up and saves assignments in `cache`, a ResultCache"""
+        self.cache = cache
+        return self
+
+    @lazy_property.LazyProperty
+    def data_fingerprint(self):
+        if self.file_hash_int:
+            return self.file_hash_int, list(self.df.columns)
+        return fingerprint(self.df)
+
+    def cache_parameters(self):
+        """parameters of the design determining its assignments, besides
+        its data, seed and weights"""
+        return dict(k=self.k, legacy_rng=self.legacy_rng,
+                    objective=self._balance)
+
+    def cache_key(self, draw_fun):
+        return fingerprint(dict(
+            design=type(self), draw_fun=draw_fun, data=self.data_fingerprint,
+            seed=self.seed, weights=self.weights,
+            parameters=self.cache_parameters()))
+
+    def instrument(self, progress=None):
+        """records stage timers and counters of subsequent runs in `stats`,
+        also attached to assignments as `attrs['stats']`, and calls
+        `progress(done, total)` as draws are scored"""
+        self.stats = RunStats(progress)
+        return self
+
+    @lazy_property.LazyProperty
+    def prepared_balance(self):
+        balance = self._balance if isinstance(
+            self._balance, NumericFunction) else NumericFunction(self._balance)
+        return balance.prepare(self.df)
+
     def balance(self, assignment):
-        return float(self._balance(
-            self.df, get_assignments_as_positions(assignment)).values)
+        with self.stats.timer('convert'):
+            positions = get_assignments_as_positions(assignment)
+        with self.stats.timer('objective'):
+            balance = float(self.prepared_balance(positions).values)
+        self.stats.count('evaluations')
+        return balance
+
+    @property
+    def supports_batch(self):
+        return self.prepared_balance.batch_func is not None
+
+    def batch_balance(self, assignments):
+        with self.stats.timer('convert'):
+            assignments = np.asarray(assignments)
+        with self.stats.timer('objective'):
+            balance = np.asarray(
+                self.prepared_balance.batch(assignments), dtype=float)
+        self.stats.count('evaluations', len(assignments))
+        return balance
+
+    @property
+    def batch_size(self):
+        return max(1, min(self.k, MAX_BATCH_ELEMENTS // self.sample_size))
 
     def assignment_generator(self, draw_fun):
         return (draw_fun(self.weights, self.sample_size) for _ in range(
             self.k))
 
+    def indexed_assignments(self, draw_fun, start=0, stop=None):
+        return (self.draw(draw_fun, i)
+                for i in range(start, self.k if stop is None else stop))
 
-class KRerandomizedRCT(BalancedRCTBase):
-    @property
-    def assignment_from_iid(self):
+    def _seed_draws(self):
         np.random.seed(self.seed)
-        assignments = self.assignment_generator(draw_iid_assignment)
-        return self._get_best_assignment(assignments)
+        random.seed(self.seed)
+
+    def draws(self, draw_fun):
+        """the `k` candidate assignments; with `legacy_rng`, these are drawn
+        in sequence from the reseeded global random state"""
+        return self._timed(self._draws(draw_fun))
+
+    def _draws(self, draw_fun):
+        if self.legacy_rng:
+            self._seed_draws()
+            return self.assignment_generator(draw_fun)
+        return self.indexed_assignments(draw_fun)
+
+    def redraw(self, draw_fun, index):
+        """candidate assignment number `index`, as returned by `draws`"""
+        with self.stats.timer('redraw'):
+            if self.legacy_rng:
+                self._seed_draws()
+                return next(islice(self.assignment_generator(draw_fun),
+                                   index, None))
+            return self.draw(draw_fun, index)
+
+    def redraws(self, draw_fun, indices):
+        """candidate assignments at sorted `indices`, as returned by
+        `draws`, leaving the global random state unchanged"""
+        with self.stats.timer('redraw'):
+            if not self.legacy_rng:
+                return [self.draw(draw_fun, index) for index in indices]
+            states = random.getstate(), np.random.get_state()
+            self._seed_draws()
+            draws = self.assignment_generator(draw_fun)
+            wanted, res = set(indices), []
+            for index, assignment in enumerate(
+                    islice(draws, max(indices, default=-1) + 1)):
+                if index in wanted:
+                    res.append(assignment)
+            random.setstate(states[0])
+            np.random.set_state(states[1])
+            return res
+
+    def _timed(self, assignments, batched=False):
+        """`assignments`, timing their generation when instrumented"""
+        if not self.stats.enabled:
+            return assignments
+        return self._timed_draws(iter(assignments), batched)
+
+    def _timed_draws(self, assignments, batched):
+        while True:
+            with self.stats.timer('draw'):
+                assignment = next(assignments, None)
+            if assignment is None:
+                return
+            self.stats.count('draws', len(assignment) if batched else 1)
+            yield assignment
+
+    def batch_sizes(self, start=0, stop=None):
+        stop = self.k if stop is None else stop
+        return [min(self.batch_size, stop - first)
+                for first in range(start, stop, self.batch_size)]
+
+    def assignment_batches(self, assignments, sizes=None):
+        assignments = iter(assignments)
+        for size in sizes or self.batch_sizes():
+            batch = list(islice(assignments, size))
+            if not batch:
+                return
+            yield batch
+
+    def draw_batches(self, draw_fun, sizes=None):
+        """the candidates of `draws` in successive batches of `sizes` (of
+        up to `batch_size` by default), as (batch, N) arrays of labels;
+        legacy shuffled draws come from `random` one at a time and are
+        batched as lists"""
+        return self._timed(self._draw_batches(draw_fun, sizes), batched=True)
+
+    def _draw_batches(self, draw_fun, sizes):
+        sizes = sizes or self.batch_sizes()
+        if not self.legacy_rng:
+            starts = np.cumsum([0] + list(sizes[:-1]))
+            return (self.indexed_batch(draw_fun, start, size)
+                    for start, size in zip(starts, sizes))
+        batch_draw = draw_iid_assignments if draw_fun is \
+            draw_iid_assignment else getattr(draw_fun, 'batch', None)
+        if batch_draw is not None:
+            self._seed_draws()
+            return (batch_draw(self.weights, self.sample_size, size)
+                    for size in sizes)
+        return self.assignment_batches(self._draws(draw_fun), sizes)
+
+    def indexed_batch(self, draw_fun, start, size):
+        """(size, N) labels of draws `start` to `start + size`, each row
+        filled from the generator of its own draw index"""
+        batch = np.empty((size, self.sample_size),
+                         dtype=label_dtype(self.weights))
+        for row, assignment in enumerate(
+                self.indexed_assignments(draw_fun, start, start + size)):
+            batch[row] = assignment
+        return batch
+
+    def indexed_batches(self, draw_fun, start=0, stop=None):
+        return self._timed(
+            self._indexed_batches(draw_fun, start, stop), batched=True)
+
+    def _indexed_batches(self, draw_fun, start, stop):
+        first = start
+        for size in self.batch_sizes(start, stop):
+            yield self.indexed_batch(draw_fun, first, size)
+            first += size
 
     @property
-    def assignment_from_shuffled(self):
-        random.seed(self.seed)
-        assignments = self.assignment_generator(draw_shuffled_assignment)
-        return self._get_best_assignment(assignments)
+    def n_streams(self):
+        return -(-self.k // DRAWS_PER_STREAM)
 
-    def _get_best_assignment(self, assignments):
-        return self.as_frame(max(assignments, key=self.balance))
+    def stream_range(self, stream):
+        """first and last (excluded) indices of the draws of `stream`"""
+        start = stream * DRAWS_PER_STREAM
+        return start, min(self.k, start + DRAWS_PER_STREAM)
+
+
+class KRerandomizedRCT(BalancedRCTBase):
+    """rerandomization keeping the best balanced of `k` candidate draws.
+    With `n_jobs` set, candidates are scored in streams of
+    `DRAWS_PER_STREAM` draws on `n_jobs` processes, each candidate being
+    drawn from its own index whatever `legacy_rng`, so that assignments do
+    not depend on `n_jobs`."""
+
+    def __init__(self, objective, file_path_or_frame, weights, k=None, seed=0,
+                 n_jobs=None, legacy_rng=True, columns=None, strata=None):
+        super().__init__(objective, file_path_or_frame, weights, k, seed,
+                         legacy_rng, columns, strata)
+        self.n_jobs = n_jobs
+        self.scores = None
+
+    score_attribute = 'scores'
+
+    def cache_parameters(self):
+        return dict(super().cache_parameters(),
+                    streams=self.n_jobs is not None)
+
+    def select_assignment(self, draw_fun):
+        if self.n_jobs is not None:
+            return self._get_best_stream_assignment(draw_fun)
+        scores = []
+        if self.supports_batch:
+            _, self.selected_draw, best = self._best_of_batches(
+                self.draw_batches(draw_fun), scores)
+        else:
+            _, self.selected_draw, best = self._best_of(
+                self.draws(draw_fun), scores)
+        self.scores = np.array(scores, dtype=float)
+        return self.as_frame(best)
+
+    def _get_best_stream_assignment(self, draw_fun):
+        self.prepared_balance
+        results = map_on_workers(
+            self, '_best_in_stream',
+            [(draw_fun, stream) for stream in range(self.n_streams)],
+            self.n_jobs)
+        return self._best_of_streams(draw_fun, results)
+
+    def _best_of_streams(self, draw_fun, results):
+        """assignment selected from the `_best_in_stream` results of all
+        streams, in stream order"""
+        for _, _, _, stats in results:
+            self.stats.merge(stats)
+        self.stats.report(self.k, self.k)
+        self.scores = np.concatenate([scores for _, _, scores, _ in results])
+        stream, (_, position, _, _) = max(
+            enumerate(results), key=lambda res: res[1][0])
+        self.selected_draw = stream * DRAWS_PER_STREAM + position
+        return self.as_frame(self.draw(draw_fun, self.selected_draw))
+
+    def _best_in_stream(self, draw_fun, stream):
+        """(score, position, scores, stats) of the best draw of `stream`,
+        stats of the stream being recorded apart from those of the run"""
+        run_stats = self.stats
+        if run_stats.enabled:
+            self.stats = RunStats()
+        try:
+            start, stop = self.stream_range(stream)
+            scores = []
+            if self.supports_batch:
+                score, position, _ = self._best_of_batches(
+                    self.indexed_batches(draw_fun, start, stop), scores)
+            else:
+                score, position, _ = self._best_of(self._timed(
+                    self.indexed_assignments(draw_fun, start, stop)), scores)
+            return score, position, np.array(scores, dtype=float), self.stats
+        finally:
+            self.stats = run_stats
+
+    def _best_of(self, assignments, scores):
+        """(score, position, assignment) of the best of `assignments`, all
+        scores being appended to `scores`"""
+        best = None
+        for i, assignment in enumerate(assignments):
+            score = self.balance(assignment)
+            scores.append(score)
+            if best is None or score > best[0]:
+                best = (score, i, assignment)
+            self.stats.report(i + 1, self.k)
+        return best
+
+    def _best_of_batches(self, batches, scores):
+        best, offset = (-np.inf, None, None), 0
+        for batch in batches:
+            batch_scores = self.batch_balance(batch)
+            scores.extend(batch_scores)
+            batch_scores = np.nan_to_num(batch_scores, nan=-np.inf)
+            with self.stats.timer('select'):
+                i = int(np.argmax(batch_scores))
+                if best[2] is None or batch_scores[i] > best[0]:
+                    best = (batch_scores[i], offset + i, batch[i])
+            offset += len(batch)
+            self.stats.report(offset, self.k)
+        return best
+
+
+class SwapSearchRCT(BalancedRCTBase):
+    """local search improving each of `num_restarts` seeded starting
+    assignments by swapping the labels of units in different arms: each of
+    up to `max_moves` moves scores `num_candidates` random swaps and makes
+    the best one if it improves balance. The assignment returned is drawn
+    at random among restart results within `tolerance` of the best
+    balance, so that the design stays randomized."""
+
+    def __init__(self, objective, file_path_or_frame, weights,
+                 num_restarts=20, max_moves=1000, num_candidates=64,
+                 tolerance=0., seed=0, legacy_rng=True, columns=None):
+        super().__init__(objective, file_path_or_frame, weights,
+                         num_restarts, seed, legacy_rng, columns)
+        self.objective = objective
+        self.max_moves = max_moves
+        self.num_candidates = num_candidates
+        self.tolerance = tolerance
+        self.balances = None
+
+    score_attribute = 'balances'
+
+    def cache_parameters(self):
+        return dict(super().cache_parameters(), max_moves=self.max_moves,
+                    num_candidates=self.num_candidates,
+                    tolerance=self.tolerance)
+
+    @lazy_property.LazyProperty
+    def covariate_data(self):
+        return CovariateData(self.df)
+
+    def search_rng(self, restart):
+        return np.random.default_rng(
+            np.random.SeedSequence(self.seed, spawn_key=(restart,)))
+
+    def swap_balance(self, labels):
+        swap_func = getattr(self._balance, 'swap_func', None)
+        if swap_func is not None:
+            swap_balance = swap_func(self.covariate_data, labels)
+            if swap_balance is not None:
+                return swap_balance
+        return SwapBalance(self.score_batch, labels)
+
+    def score_batch(self, assignments):
+        if self.supports_batch:
+            return self.batch_balance(assignments)
+        return np.array([self.balance(a) for a in assignments])
+
+    def local_search(self, labels, restart):
+        """(balance, labels) reached by swaps from `labels`"""
+        rng = self.search_rng(restart)
+        state = self.swap_balance(labels)
+        balance = np.nan_to_num(state.balance, nan=-np.inf)
+        for _ in range(self.max_moves):
+            first, second = rng.integers(
+                len(state.labels), size=(2, self.num_candidates))
+            valid = state.labels[first] != state.labels[second]
+            if not valid.any():
+                continue
+            first, second = first[valid], second[valid]
+            scores = np.nan_to_num(state.scores(first, second), nan=-np.inf)
+            best = int(np.argmax(scores))
+            if scores[best] > balance:
+                state.swap(first[best], second[best])
+                balance = scores[best]
+        return balance, state.labels
+
+    def select_assignment(self, draw_fun):
+        results = [self.local_search(labels, restart)
+                   for restart, labels in enumerate(self.draws(draw_fun))]
+        self.balances = np.array([balance for balance, _ in results])
+        near_optimal = np.flatnonzero(
+            self.balances >= self.balances.max() - self.tolerance)
+        self.selected_draw = self.search_rng(self.k).choice(near_optimal)
+        return self.as_frame(results[self.selected_draw][1])
 
 
 class QuantileTargetingRCT(BalancedRCTBase):
     def __init__(self, objective, file_path_or_frame, weights,
-                 quantile_target=None, seed=0, num_monte_carlo=1000):
-        super().__init__(objective, file_path_or_frame, weights, num_monte_carlo, seed)
+                 quantile_target=None, seed=0, num_monte_carlo=1000,
+                 legacy_rng=True, columns=None, strata=None):
+        super().__init__(objective, file_path_or_frame, weights,
+                         num_monte_carlo, seed, legacy_rng, columns, strata)
         self.quantile_target = quantile_target
 
-    def balance(self, assignment):
-        return float(self._balance(
-            self.df, get_assignments_as_positions(assignment)).values)
+    def cache_parameters(self):
+        return dict(super().cache_parameters(),
+                    quantile_target=self.quantile_target)
 
-    @property
-    def assignment_from_iid(self):
+    def _seed_draws(self):
         np.random.seed(self.seed)
-        assignments = self.assignment_generator(draw_iid_assignment)
-        return self.get_target_assignments(assignments)
+        random.seed(self.seed + 1)
 
-    @property
-    def assignment_from_shuffled(self):
-        random.seed(self.seed)
-        assignments = self.assignment_generator(draw_shuffled_assignment)
-        return self.get_target_assignments(assignments)
+    def select_assignment(self, draw_fun):
+        qtargets = self.quantile_targets(draw_fun)
+        qtargets.compute_best()
+        return self._select_among(draw_fun, qtargets)
 
-    def get_target_assignments(self, assignments):
-        random.seed(self.seed + 1)
-        qtargets = QuantileTarget(
-            self.quantile_target, self.balance, assignments, self.k)
+    def quantile_targets(self, draw_fun, start=0, stop=None):
+        """QuantileTarget of the `k` candidates, or of candidates `start`
+        to `stop` (excluded) if `stop` is set"""
+        if self.supports_batch:
+            draws = self.draw_batches(draw_fun) if stop is None else \
+                self.indexed_batches(draw_fun, start, stop)
+            return QuantileTarget(
+                self.quantile_target, self.batch_balance, draws, self.k,
+                batched=True, stats=self.stats, start=start)
+        draws = self.draws(draw_fun) if stop is None else self._timed(
+            self.indexed_assignments(draw_fun, start, stop))
+        return QuantileTarget(self.quantile_target, self.balance, draws,
+                              self.k, stats=self.stats, start=start,
+                              redraw=partial(self.redraws, draw_fun))
+
+    def _select_among(self, draw_fun, qtargets):
+        _, self.selected_draw = self._choice(qtargets.quantiles)
+        return self.as_frame(self.redraw(draw_fun, self.selected_draw))
+
+    def shard_ranges(self, num_shards):
+        """(start, stop) draw index ranges of `num_shards` shards"""
+        bounds = np.linspace(0, self.k, num_shards + 1).astype(int)
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    def run_shard(self, scheme, start, stop):
+        """json serializable summary of the best of candidates `start` to
+        `stop` drawn by `scheme`, identifying the design; summaries of
+        shards covering all draws are combined by `merge_shards`"""
+        if self.legacy_rng:
+            raise ValueError('sharded runs require legacy_rng=False')
+        draw_fun = self.draw_scheme(scheme)
+        qtargets = self.quantile_targets(draw_fun, start, stop)
         qtargets.compute_best()
-        _, selected_assignment = random.choice(qtargets.quantiles)
-        return self.as_frame(selected_assignment)
+        return dict(qtargets.summary(), scheme=scheme,
+                    design=self.cache_key(draw_fun))
+
+    def merge_shards(self, summaries):
+        """assignment a single run would select, from the summaries of
+        shards of the design covering all draws"""
+        summaries = sorted(summaries, key=itemgetter('start'))
+        if not summaries:
+            raise ValueError('shards do not cover all draws')
+        scheme = summaries[0]['scheme']
+        draw_fun = self.draw_scheme(scheme)
+        if any(summary['scheme'] != scheme or
+               summary['design'] != self.cache_key(draw_fun)
+               for summary in summaries):
+            raise ValueError('summaries of another design')
+        qtargets = reduce(QuantileTarget.merge, map(
+            QuantileTarget.from_summary, summaries))
+        if qtargets.start != 0 or qtargets.num_draws != self.k:
+            raise ValueError('shards do not cover all draws')
+        return self._select_among(draw_fun, qtargets)
+
+    def _choice(self, candidates):
+        if self.legacy_rng:
+            return random.choice(candidates)
+        # the generator following the last candidate draw
+        rng = draw_rng(self.seed, self.k)
+        return candidates[rng.integers(len(candidates))]
+
+
+class ThresholdRerandomizedRCT(BalancedRCTBase):
+    """sequential rerandomization, returning the first candidate whose
+    balance reaches `threshold`, or lies in the top `quantile_target` of
+    `num_pilot` preliminary draws; at most `max_draws` candidates, pilot
+    included, are drawn, after which the best post-pilot candidate is
+    returned and `accepted` is False"""
+
+    def __init__(self, objective, file_path_or_frame, weights, threshold=None,
+                 quantile_target=None, num_pilot=100, max_draws=10000,
+                 seed=0, legacy_rng=True, columns=None):
+        if (threshold is None) == (quantile_target is None):
+            raise ValueError(
+                'exactly one of threshold and quantile_target must be set')
+        num_pilot = 0 if quantile_target is None else num_pilot
+        if quantile_target is not None and num_pilot < 1:
+            raise ValueError('quantile_target requires num_pilot >= 1')
+        if max_draws <= num_pilot:
+            raise ValueError('max_draws must exceed num_pilot')
+        super().__init__(objective, file_path_or_frame, weights, max_draws,
+                         seed, legacy_rng, columns)
+        self.threshold = threshold
+        self.quantile_target = quantile_target
+        self.num_pilot = num_pilot
+        self.acceptance_threshold = threshold
+        self.num_draws = None
+        self.accepted = None
+        self.scores = None
+
+    score_attribute = 'scores'
+    result_attributes = ('acceptance_threshold', 'num_draws', 'accepted')
+
+    def cache_parameters(self):
+        return dict(super().cache_parameters(), threshold=self.threshold,
+                    quantile_target=self.quantile_target,
+                    num_pilot=self.num_pilot)
+
+    def select_assignment(self, draw_fun):
+        pilot_scores, best, drawn = [], (-np.inf, None, None), []
+        self.num_draws, self.accepted = 0, False
+        for batch, scores in self._scored_batches(draw_fun):
+            self.num_draws += len(batch)
+            drawn.append(scores)
+            if self.num_draws <= self.num_pilot:
+                pilot_scores.extend(scores)
+                if self.num_draws == self.num_pilot:
+                    self.acceptance_threshold = self.pilot_threshold(
+                        pilot_scores)
+                continue
+            accepted = np.flatnonzero(scores >= self.acceptance_threshold)
+            if len(accepted):
+                self.num_draws -= len(batch) - accepted[0] - 1
+                self.scores = np.concatenate(drawn)[:self.num_draws]
+                self.accepted = True
+                self.selected_draw = self.num_draws - 1
+                return self.as_frame(batch[accepted[0]])
+            i = int(np.argmax(scores))
+            if best[1] is None or scores[i] > best[0]:
+                best = (scores[i], batch[i], self.num_draws - len(batch) + i)
+        self.scores = np.concatenate(drawn)
+        self.selected_draw = best[2]
+        return self.as_frame(best[1])
+
+    def pilot_threshold(self, pilot_scores):
+        """balance of the worst pilot draw in the top `quantile_target`"""
+        num_q = max(1, int(self.quantile_target * len(pilot_scores)))
+        return np.sort(pilot_scores)[-num_q]
+
+    def _scored_batches(self, draw_fun):
+        if self.supports_batch:
+            batches = self.draw_batches(draw_fun, self.sequential_sizes())
+            score = self.batch_balance
+        else:
+            batches = self.assignment_batches(
+                self.draws(draw_fun), self.sequential_sizes())
+            score = partial(map, self.balance)
+        for batch in batches:
+            yield batch, np.nan_to_num(
+                np.fromiter(score(batch), float, len(batch)), nan=-np.inf)
+
+    def sequential_sizes(self):
+        """pilot batches, then batches doubling in size from a single draw
+        so that little is drawn past the first accepted candidate"""
+        sizes, size = self.batch_sizes(0, self.num_pilot), 1
+        drawn = self.num_pilot
+        while drawn < self.k:
+            sizes.append(min(size, self.k - drawn))
+            drawn += sizes[-1]
+            size = min(2 * size, self.batch_size)
+        return sizes
+
+
+class CohortBatch:
+    """k-rerandomized assignments of many cohorts sharing a design spec:
+    `cohorts` maps names to covariate frames or files (a list is named by
+    position), each cohort being a KRerandomizedRCT with its own seed,
+    derived from its data and `seed` as for a single design.
+
+    The draws of all cohorts are scored as (cohort, stream) work units on
+    a single pool of `n_jobs` processes, largest units first so that large
+    cohorts do not hold up the end of the run. The assignment of each
+    cohort is that of its design with `n_jobs` set, whatever `n_jobs`."""
+
+    def __init__(self, objective, cohorts, weights, k=None, seed=0,
+                 n_jobs=None, columns=None, strata=None):
+        if not isinstance(cohorts, dict):
+            cohorts = dict(enumerate(cohorts))
+        self.names = list(cohorts)
+        self.designs = [KRerandomizedRCT(
+            objective, cohorts[name], weights, k, seed, n_jobs=1,
+            columns=columns, strata=strata) for name in self.names]
+        self.n_jobs = n_jobs
+
+    def instrument(self, progress=None):
+        """records stats of subsequent runs for each cohort, see
+        `BalancedRCTBase.instrument`"""
+        for design in self.designs:
+            design.instrument(progress)
+        return self
+
+    @property
+    def stats(self):
+        return dict(zip(self.names, (design.stats
+                                     for design in self.designs)))
+
+    @property
+    def scores(self):
+        return dict(zip(self.names, (design.scores
+                                     for design in self.designs)))
+
+    def work_units(self):
+        """(cohort, stream) pairs, by decreasing number of covariate rows
+        drawn"""
+        units = [(cohort, stream)
+                 for cohort, design in enumerate(self.designs)
+                 for stream in range(design.n_streams)]
+        return sorted(units, key=lambda unit: -self._unit_size(*unit))
+
+    def _unit_size(self, cohort, stream):
+        design = self.designs[cohort]
+        start, stop = design.stream_range(stream)
+        return design.sample_size * (stop - start)
+
+    def assignments(self, scheme='iid'):
+        """dict of the assignments of cohorts drawn by `scheme`, 'iid',
+        'shuffled' or 'stratified'"""
+        for design in self.designs:
+            design.prepared_balance
+        units = self.work_units()
+        results = dict(zip(units, map_on_workers(
+            self, '_best_in_stream',
+            [(scheme, cohort, stream) for cohort, stream in units],
+            1 if self.n_jobs is None else self.n_jobs, chunksize=1)))
+        return dict((name, design._best_of_streams(
+            design.draw_scheme(scheme),
+            [results[cohort, stream] for stream in range(design.n_streams)]))
+            for cohort, (name, design) in enumerate(zip(self.names,
+                                                        self.designs)))
+
+    def _best_in_stream(self, scheme, cohort, stream):
+        design = self.designs[cohort]
+        return design._best_in_stream(design.draw_scheme(scheme), stream)
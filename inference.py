@@ -0,0 +1,148 @@
+import copy
+
+import lazy_property
+import numpy as np
+import pandas as pd
+
+from .assignment import clean_weights
+from .balance import arm_masks, arm_sums
+from .utils import map_on_workers, NO_STATS
+
+GRID_POINTS = 2001
+MAX_WIDENINGS = 10
+
+
+def arm_mean_differences(values, labels, n_arms):
+    """(K, arms - 1, p) differences between the means of the columns of
+    `values` in each treatment arm and in arm 0, for a (K, N) matrix of
+    labels"""
+    counts, sums = arm_sums(values, arm_masks(labels, n_arms))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+    return np.moveaxis(means[1:] - means[0], 0, 1)
+
+
+class RandomizationInference:
+    """randomization p-values and confidence intervals for the effects of
+    treatment arms on `outcomes`, comparing the observed `assignment` to
+    `num_replications` assignments of `design` rerun with seeds derived
+    from its own, so that replicated assignments follow the design's
+    (rerandomized) distribution.
+
+    Tests are of sharp nulls under which each arm shifts outcomes by a
+    constant effect relative to arm 0, with the difference in means as
+    test statistic. Replications run on `n_jobs` processes, each rerunning
+    the design on its prepared covariate state; results do not depend on
+    `n_jobs`."""
+
+    def __init__(self, design, outcomes, assignment=None, scheme='iid',
+                 num_replications=1000, n_jobs=1):
+        self.design = design
+        self.scheme = scheme
+        if assignment is None:
+            assignment = self._assignment(design)
+        self.assignment = np.asarray(assignment).ravel().astype(int)
+        self.outcomes = np.asarray(outcomes, dtype=float).ravel()
+        self.n_arms = len(clean_weights(design.weights))
+        self.num_replications = num_replications
+        self.n_jobs = n_jobs
+
+    def _assignment(self, design):
+        return getattr(design, 'assignment_from_{}'.format(self.scheme)).t
+
+    def replication_seed(self, replication):
+        """seed shift of `replication`, derived from the design seed"""
+        return int(np.random.SeedSequence(
+            self.design.seed, spawn_key=(replication,)).generate_state(1)[0])
+
+    def replica(self, replication):
+        """copy of the design seeded for `replication`, sharing its
+        prepared state"""
+        replica = copy.copy(self.design)
+        replica.shift_seed = self.replication_seed(replication)
+        vars(replica).pop('_seed', None)
+        replica.cache, replica.stats = None, NO_STATS
+        if getattr(replica, 'n_jobs', None) is not None:
+            replica.n_jobs = 1
+        return replica
+
+    def _replicate(self, start, stop):
+        return np.stack([self._assignment(self.replica(replication)).values
+                         for replication in range(start, stop)])
+
+    @lazy_property.LazyProperty
+    def replications(self):
+        """(num_replications, N) labels of the replicated assignments"""
+        if hasattr(self.design, 'prepared_balance'):
+            self.design.prepared_balance
+        n_chunks = 4 * (1 if self.n_jobs in (None, 1) else abs(self.n_jobs))
+        bounds = np.linspace(0, self.num_replications,
+                             min(n_chunks, self.num_replications) + 1)
+        bounds = bounds.astype(int)
+        return np.concatenate(map_on_workers(
+            self, '_replicate', list(zip(bounds[:-1], bounds[1:])),
+            self.n_jobs))
+
+    @lazy_property.LazyProperty
+    def _differences(self):
+        """differences in means of outcomes and of observed arm dummies,
+        for the observed assignment and each replication"""
+        dummies = self.assignment[:, None] == np.arange(1, self.n_arms)
+        values = np.column_stack([self.outcomes, dummies])
+        return [arm_mean_differences(values, labels, self.n_arms)
+                for labels in [self.assignment[None, :], self.replications]]
+
+    def _index(self):
+        return ['t{}'.format(arm) for arm in range(1, self.n_arms)]
+
+    @property
+    def estimates(self):
+        """differences in mean outcomes between treatment arms and arm 0"""
+        return pd.Series(self._differences[0][0, :, 0], index=self._index())
+
+    def pvalues(self, effects=0.):
+        """p-values of the sharp null that arms shift outcomes by
+        `effects`, a scalar or one effect per treatment arm"""
+        effects = np.broadcast_to(np.asarray(effects, dtype=float),
+                                  (self.n_arms - 1,))
+        observed, replicated = self._differences
+        statistics = observed[0, :, 0] - effects
+        null_statistics = replicated[:, :, 0] - replicated[:, :, 1:] @ effects
+        return pd.Series(self._pvalues(statistics, null_statistics),
+                         index=self._index())
+
+    def _pvalues(self, statistics, null_statistics):
+        extreme = np.abs(null_statistics) >= np.abs(statistics) - 1e-12
+        return (1 + np.sum(extreme, axis=0)) / (1 + len(null_statistics))
+
+    def confidence_intervals(self, alpha=.05):
+        """(lower, upper) bounds of the effects of each treatment arm not
+        rejected at level `alpha`, found on a grid, effects of other arms
+        being set to their estimates"""
+        observed, replicated = self._differences
+        estimates = observed[0, :, 0]
+        bounds = []
+        for arm in range(self.n_arms - 1):
+            others = estimates.copy()
+            others[arm] = 0.
+            offset = replicated[:, arm, 0] - replicated[:, arm, 1:] @ others
+            slope = replicated[:, arm, 1 + arm]
+            bounds.append(self._inverted_test(
+                estimates[arm], offset, slope, alpha))
+        return pd.DataFrame(bounds, index=self._index(),
+                            columns=['lower', 'upper'])
+
+    def _inverted_test(self, estimate, offset, slope, alpha):
+        null_spread = np.nanstd(offset - estimate * slope)
+        width = 4 * null_spread if null_spread > 0 else 1.
+        for _ in range(MAX_WIDENINGS):
+            grid = estimate + np.linspace(-width, width, GRID_POINTS)
+            pvalues = self._pvalues(
+                estimate - grid, offset[:, None] - slope[:, None] * grid)
+            accepted = np.flatnonzero(pvalues > alpha)
+            if not len(accepted):
+                return np.nan, np.nan
+            if 0 < accepted[0] and accepted[-1] < GRID_POINTS - 1:
+                return grid[accepted[0]], grid[accepted[-1]]
+            width *= 2
+        return grid[accepted[0]], grid[accepted[-1]]
@@ -0,0 +1,206 @@
+from hashlib import md5
+from functools import partial
+from os import path
+import io
+import os
+import tempfile
+import weakref
+
+import numpy as np
+import pandas as pd
+
+CHUNK_SIZE = 2 ** 20
+CHUNK_ROWS = 2 ** 16
+
+
+class HashingReader(io.RawIOBase):
+    """binary file wrapper feeding the bytes read through it to `hasher`"""
+
+    def __init__(self, fh, hasher):
+        self.fh = fh
+        self.hasher = hasher
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.fh.readinto(buffer)
+        self.hasher.update(memoryview(buffer)[:size])
+        return size
+
+
+def hash_file(file_path):
+    """md5 of the bytes of `file_path`, read in chunks"""
+    hasher = md5()
+    with open(file_path, 'rb') as fh:
+        for chunk in iter(partial(fh.read, CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+def read_csv(file_path, columns=None):
+    """parses `file_path` and hashes its bytes in a single pass"""
+    hasher = md5()
+    with open(file_path, 'rb') as fh:
+        reader = io.BufferedReader(HashingReader(fh, hasher), CHUNK_SIZE)
+        df = pd.read_csv(reader, usecols=columns)
+        while reader.read(CHUNK_SIZE):
+            pass
+    return df, hasher
+
+
+def read_npy(file_path, columns=None):
+    """frame of a 2d or structured array saved with `np.save`; columns of
+    2d arrays are named x0, x1, ..."""
+    array = np.load(file_path, mmap_mode='r')
+    if array.dtype.names:
+        names = list(columns or array.dtype.names)
+        return pd.DataFrame({name: np.asarray(array[name]) for name in names})
+    names = ['x{}'.format(i) for i in range(array.shape[1])]
+    columns = list(columns or names)
+    selection = [names.index(col) for col in columns]
+    return pd.DataFrame(np.asarray(array[:, selection]), columns=columns)
+
+
+BINARY_READERS = {
+    '.parquet': lambda file_path, columns: pd.read_parquet(
+        file_path, columns=columns),
+    '.feather': lambda file_path, columns: pd.read_feather(
+        file_path, columns=columns),
+    '.npy': read_npy,
+}
+
+
+def read_covariates(file_path, columns=None):
+    """(DataFrame, md5 hasher of the file bytes) of a csv, parquet, feather
+    or npy file, loading only `columns` if given"""
+    reader = BINARY_READERS.get(path.splitext(file_path)[1].lower())
+    if reader is None:
+        return read_csv(file_path, columns)
+    return reader(file_path, columns), hash_file(file_path)
+
+
+def row_chunks(values, chunk_rows=CHUNK_ROWS):
+    """(first row, array) chunks of the rows of `values`"""
+    for start in range(0, len(values), chunk_rows):
+        yield start, np.asarray(values[start:start + chunk_rows])
+
+
+def column_means(values):
+    """column means of `values`, read in chunks, leaving out missing
+    values"""
+    sums, counts = 0., 0
+    for _, chunk in row_chunks(values):
+        sums = sums + np.nansum(chunk, axis=0)
+        counts = counts + np.sum(~np.isnan(chunk), axis=0)
+    return sums / counts
+
+
+def column_covariance(values):
+    """sample covariance matrix of the columns of `values`, read in chunks,
+    each pair of columns over the rows where both are observed"""
+    counts, sums, products = 0., 0., 0.
+    for _, chunk in row_chunks(values):
+        observed = (~np.isnan(chunk)).astype(float)
+        filled = np.where(observed, chunk, 0.)
+        counts = counts + observed.T @ observed
+        sums = sums + filled.T @ observed
+        products = products + filled.T @ filled
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (products - sums * sums.T / counts) / (counts - 1)
+
+
+class ColumnView:
+    """selected columns of a CovariateStore, less an optional offset, read
+    a chunk of rows at a time"""
+
+    def __init__(self, store, columns, offset=None):
+        self.store = store
+        self.positions = [store.columns.get_loc(col) for col in columns]
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, rows):
+        chunk = np.asarray(self.store.array[rows][..., self.positions])
+        return chunk if self.offset is None else chunk - self.offset
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+class CovariateStore:
+    """read-only float64 covariate matrix memory-mapped from a raw file;
+    pickles as its path, so that worker processes share its pages.
+    Stores built by `from_frame` or `from_file` without a `file_path`
+    live in a temporary file removed along with the store."""
+
+    def __init__(self, file_path, columns, num_rows, hash_int=0):
+        self.file_path = file_path
+        self.columns = pd.Index(columns)
+        self.index = pd.RangeIndex(num_rows)
+        self.hash_int = hash_int
+        self._array = None
+
+    @classmethod
+    def from_frame(cls, df, file_path=None, hash_int=0):
+        return cls._write([df], file_path, hash_int)
+
+    @classmethod
+    def from_file(cls, source_path, file_path=None, columns=None):
+        """store of a covariate file, csv files being parsed, hashed and
+        written a chunk of rows at a time"""
+        if path.splitext(source_path)[1].lower() in BINARY_READERS:
+            df, hasher = read_covariates(source_path, columns)
+            return cls.from_frame(df, file_path, int(hasher.hexdigest(), 16))
+        hasher = md5()
+        with open(source_path, 'rb') as fh:
+            reader = io.BufferedReader(HashingReader(fh, hasher), CHUNK_SIZE)
+            store = cls._write(pd.read_csv(
+                reader, usecols=columns, chunksize=CHUNK_ROWS), file_path)
+            while reader.read(CHUNK_SIZE):
+                pass
+        store.hash_int = int(hasher.hexdigest(), 16)
+        return store
+
+    @classmethod
+    def _write(cls, frames, file_path, hash_int=0):
+        temporary = file_path is None
+        if temporary:
+            fd, file_path = tempfile.mkstemp(suffix='.covariates')
+            os.close(fd)
+        columns, num_rows = [], 0
+        with open(file_path, 'wb') as fh:
+            for df in frames:
+                columns = list(df.columns)
+                fh.write(np.ascontiguousarray(
+                    df.values, dtype=np.float64).tobytes())
+                num_rows += len(df)
+        store = cls(file_path, columns, num_rows, hash_int)
+        if temporary:
+            weakref.finalize(store, os.remove, file_path)
+        return store
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.memmap(
+                self.file_path, dtype=np.float64, mode='r',
+                shape=(len(self.index), len(self.columns)))
+        return self._array
+
+    def __getstate__(self):
+        return dict(self.__dict__, _array=None)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, cols):
+        """covariates in memory, as a Series for a single column"""
+        if not isinstance(cols, (list, tuple, pd.Index)):
+            return self[[cols]][cols]
+        return pd.DataFrame(np.asarray(ColumnView(self, cols)), columns=cols)
+
+    def column_view(self, cols, offset=None):
+        return ColumnView(self, cols, offset)
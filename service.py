@@ -0,0 +1,237 @@
+"""local assignment service keeping designs warm between requests.
+
+Clients send json requests, one per line, over a localhost tcp or unix
+socket connection, and get one json response line per request, tagged with
+the request `id`, in order of completion:
+
+    {"id": 1, "op": "assign", "input": "cohort.csv",
+     "options": {"design": "krct", "k": 1000, "objective": "mahalanobis"},
+     "deadline": 10}
+    {"id": 1, "result": {"index": [...], "t": [...], "seed": ..., ...}}
+
+`op` is one of `assign`, `balance_report` or `scores`, and `options` are
+those of `python -m rct assign`. Requests run on a pool of `n_jobs` worker
+processes, each keeping up to `MAX_DESIGNS` designs with their covariates,
+prepared objective and results in memory, so that repeated requests on a
+cohort skip reading, preparing and drawing. At most `max_pending` requests
+are in flight: beyond that, requests are neither dispatched nor further
+lines read from their connection until some complete, idle connections
+holding no slot. Requests still running at their deadline get an error
+response; their worker completes them in the background and caches the
+result.
+
+    python -m rct.service --port 8765 --n-jobs 4
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from .cache import ResultCache
+from .cli import assign_options, make_design
+from .balance import pvalues_report
+
+DEFAULT_PORT = 8765
+MAX_DESIGNS = 16
+OPERATIONS = ['assign', 'balance_report', 'scores']
+_designs = OrderedDict()
+
+
+class ServiceError(Exception):
+    """error response of the service"""
+
+
+def warm_design(file_path, options):
+    """design of `file_path` with `options`, kept by the worker process
+    until `MAX_DESIGNS` more recently used designs are"""
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size,
+           json.dumps(options, sort_keys=True))
+    design = _designs.get(key)
+    if design is None:
+        design = make_design(file_path, assign_options(**options))
+        if hasattr(design, 'use_cache'):
+            design.use_cache(ResultCache())
+        _designs[key] = design
+        while len(_designs) > MAX_DESIGNS:
+            _designs.popitem(last=False)
+    _designs.move_to_end(key)
+    return design
+
+
+def run_request(op, file_path, options):
+    """json result of operation `op` on `file_path`"""
+    design = warm_design(file_path, options)
+    scheme = options.get('scheme', 'iid')
+    if hasattr(design, 'instrument'):
+        design.instrument()
+    if op == 'scores':
+        distribution = design.balance_distribution(scheme)
+        return dict(scores=distribution.scores.tolist(),
+                    selected=float(distribution.selected),
+                    rank=distribution.rank,
+                    quantiles=dict((str(q), value) for q, value in
+                                   distribution.quantiles().items()))
+    assignment = getattr(design, 'assignment_from_{}'.format(scheme))
+    if op == 'balance_report':
+        return pvalues_report(design.df, assignment).to_dict(orient='index')
+    return dict(index=assignment.index.tolist(),
+                t=assignment.t.tolist(), seed=design.seed,
+                stats=assignment.attrs.get('stats', {}))
+
+
+class AssignmentService:
+    def __init__(self, n_jobs=1, max_pending=64, deadline=None):
+        self.n_jobs = n_jobs
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self.executor = None
+        self.server = None
+        self._pending = None
+
+    async def start(self, host='127.0.0.1', port=DEFAULT_PORT,
+                    unix_path=None):
+        """starts serving and returns the address of the socket"""
+        self.executor = ProcessPoolExecutor(self.n_jobs)
+        self._pending = asyncio.Semaphore(self.max_pending)
+        if unix_path is None:
+            self.server = await asyncio.start_server(
+                self._serve_connection, host, port)
+        else:
+            self.server = await asyncio.start_unix_server(
+                self._serve_connection, unix_path)
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    async def handle(self, request):
+        """response to `request`, a dict"""
+        response = dict(id=request.get('id'))
+        try:
+            if request.get('op') not in OPERATIONS:
+                raise ValueError('unknown op: {}'.format(request.get('op')))
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, run_request, request['op'],
+                request['input'], request.get('options', {}))
+            response['result'] = await asyncio.wait_for(
+                future, request.get('deadline', self.deadline))
+        except asyncio.TimeoutError:
+            response['error'] = 'deadline exceeded'
+        except Exception as e:
+            response['error'] = '{}: {}'.format(type(e).__name__, e)
+        return response
+
+    async def _serve_connection(self, reader, writer):
+        tasks, lock = set(), asyncio.Lock()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self._pending.acquire()
+                task = asyncio.ensure_future(
+                    self._respond(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def _respond(self, line, writer, lock):
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = dict(op=None)
+            response = await self.handle(request)
+        finally:
+            self._pending.release()
+        async with lock:
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+
+
+class ServiceClient:
+    """connection to an AssignmentService, on which concurrent requests
+    are matched to their responses by id"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._ids = count()
+        self._responses = {}
+        self._reading = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=DEFAULT_PORT,
+                      unix_path=None):
+        if unix_path is None:
+            reader, writer = await asyncio.open_connection(host, port)
+        else:
+            reader, writer = await asyncio.open_unix_connection(unix_path)
+        return cls(reader, writer)
+
+    async def request(self, op, file_path, deadline=None, **options):
+        """result of operation `op` on covariate file `file_path`"""
+        request_id = next(self._ids)
+        request = dict(id=request_id, op=op, input=file_path,
+                       options=options)
+        if deadline is not None:
+            request['deadline'] = deadline
+        response = asyncio.get_running_loop().create_future()
+        self._responses[request_id] = response
+        self.writer.write(json.dumps(request).encode() + b'\n')
+        await self.writer.drain()
+        response = await response
+        if 'error' in response:
+            raise ServiceError(response['error'])
+        return response['result']
+
+    async def _read(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            self._responses.pop(response['id']).set_result(response)
+        for response in self._responses.values():
+            response.set_exception(ServiceError('connection closed'))
+
+    async def close(self):
+        self.writer.close()
+        await self._reading
+
+
+async def serve(host, port, unix_path, n_jobs, max_pending, deadline):
+    service = AssignmentService(n_jobs, max_pending, deadline)
+    address = await service.start(host, port, unix_path)
+    print('serving on {}'.format(address), flush=True)
+    async with service.server:
+        await service.server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m rct.service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', help='unix socket path, instead of tcp')
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--max-pending', type=int, default=64)
+    parser.add_argument('--deadline', type=float,
+                        help='default request deadline in seconds')
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args.host, args.port, args.unix, args.n_jobs,
+                      args.max_pending, args.deadline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
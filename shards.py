@@ -0,0 +1,71 @@
+"""sharded runs of quantile targeting designs: each shard scores a range of
+the draws of a design, saved with `save_design`, and writes a small json
+summary of its best draws; merging the summaries of all shards gives the
+assignment a single run of the design would select.
+
+    python -m rct.shards run design.pkl 3 8 --scheme iid --output 3.json
+    python -m rct.shards merge design.pkl 0.json ... 7.json --output t.csv
+"""
+import argparse
+import json
+import pickle
+import sys
+
+
+def save_design(design, file_path):
+    with open(file_path, 'wb') as fh:
+        pickle.dump(design, fh)
+
+
+def load_design(file_path):
+    with open(file_path, 'rb') as fh:
+        return pickle.load(fh)
+
+
+def run_shard(design, shard, num_shards, scheme='iid'):
+    """summary of shard number `shard` of `num_shards`"""
+    start, stop = design.shard_ranges(num_shards)[shard]
+    return design.run_shard(scheme, start, stop)
+
+
+def merge(design, summary_paths):
+    summaries = []
+    for summary_path in summary_paths:
+        with open(summary_path) as fh:
+            summaries.append(json.load(fh))
+    return design.merge_shards(summaries)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m rct.shards')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run a shard of a design')
+    run_parser.add_argument('design', help='pickled design')
+    run_parser.add_argument('shard', type=int)
+    run_parser.add_argument('num_shards', type=int)
+    run_parser.add_argument('--scheme', default='iid',
+                            choices=['iid', 'shuffled', 'stratified'])
+    run_parser.add_argument('--output', help='json file for the summary')
+    merge_parser = commands.add_parser(
+        'merge', help='merge shard summaries into an assignment')
+    merge_parser.add_argument('design', help='pickled design')
+    merge_parser.add_argument('summaries', nargs='+')
+    merge_parser.add_argument('--output', help='csv file for the assignment')
+    args = parser.parse_args(argv)
+    design = load_design(args.design)
+    if args.command == 'run':
+        summary = json.dumps(
+            run_shard(design, args.shard, args.num_shards, args.scheme))
+        if args.output is None:
+            print(summary)
+        else:
+            with open(args.output, 'w') as fh:
+                fh.write(summary)
+        return 0
+    assignment = merge(design, args.summaries)
+    assignment.to_csv(args.output or sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,14 @@
 import numpy as np
+import pandas as pd
 from parameterized import parameterized
 from numpy.testing import assert_array_almost_equal, assert_array_equal
 from random import seed
 from itertools import zip_longest
 
 from ..assignment import clean_weights, draw_iid_assignment, \
-    draw_shuffled_assignment, get_assignments_as_positions
+    draw_shuffled_assignment, get_assignments_as_positions, draw_rng, \
+    draw_iid_assignments, StratifiedDraw, \
+    arm_targets
 
 
 def test_clean_weights():
@@ -34,11 +37,78 @@ def test_draw_shuffle(weights, expected):
     assert_array_almost_equal(draw_shuffled_assignment(weights, 10), expected)
 
 
+def test_draw_from_generator():
+    rng = np.random.default_rng(0)
+    assert len(draw_iid_assignment([.3, .2], 10, rng)) == 10
+    assert_array_equal(
+        np.sort(draw_shuffled_assignment([.3, .2], 10, rng)),
+        [0, 0, 0, 0, 0, 1, 1, 1, 2, 2])
+
+
+@parameterized.expand([[np.random.RandomState], [np.random.default_rng]])
+def test_draw_iid_batch(make_rng):
+    batch = draw_iid_assignments([.3, .2], 10, 4, make_rng(0))
+    assert batch.dtype == np.uint8
+    rng = make_rng(0)
+    assert_array_equal(
+        batch, [draw_iid_assignment([.3, .2], 10, rng) for _ in range(4)])
+
+
+def test_draw_rng():
+    assert_array_equal(draw_rng(3, 5).random(4), draw_rng(3, 5).random(4))
+    assert not np.allclose(draw_rng(3, 5).random(4), draw_rng(3, 6).random(4))
+    assert not np.allclose(draw_rng(3, 5).random(4), draw_rng(4, 5).random(4))
+
+
 @parameterized.expand([
-    [[0, 0, 0, 0, 1], [[0, 1, 2, 3]]],
-    [[1, 1, 0, 0, 0], [[2, 3, 4]]],
-    [[0, 2, 0, 1], [[0, 2], [3]]]
+    [[0, 0, 0, 0, 1], [[0, 1, 2, 3], [4]]],
+    [[1, 1, 0, 0, 0], [[2, 3, 4], [0, 1]]],
+    [[0, 2, 0, 1], [[0, 2], [3], [1]]],
+    [[[2], [0], [2]], [[1], [], [0, 2]]]
 ])
 def test_get_assignments_as_position(assignment, expected):
     assert all(np.array_equal(a, b) for a, b in zip_longest(
         get_assignments_as_positions(assignment), expected))
+
+
+def test_assignment_masks():
+    positions = get_assignments_as_positions(np.array([1, 0, 2, 1]))
+    assert_array_equal(positions.labels, [1, 0, 2, 1])
+    assert_array_equal(positions.masks, [[False, True, False, False],
+                                         [True, False, False, True],
+                                         [False, False, True, False]])
+
+
+def test_arm_targets():
+    assert_array_equal(arm_targets([.3, .3, .4], 103), [31, 31, 41])
+    assert_array_equal(arm_targets(.5, 7), [4, 3])
+
+
+@parameterized.expand([[np.random.RandomState], [np.random.default_rng]])
+def test_stratified_draw(make_rng):
+    strata = np.random.RandomState(0).randint(5, size=103)
+    draw = StratifiedDraw(strata)
+    batch = draw.batch([.3, .3, .4], 103, 20, make_rng(0))
+    assert batch.dtype == np.uint8
+    rng = make_rng(0)
+    assert_array_equal(
+        batch, [draw([.3, .3, .4], 103, rng) for _ in range(20)])
+    for assignment in batch:
+        assert_array_equal(np.bincount(assignment), [31, 31, 41])
+        counts = pd.crosstab(strata, assignment).values
+        floors = np.floor(np.outer(np.bincount(strata), [.3, .3, .4]))
+        assert ((counts >= floors) & (counts - floors <= 2)).all()
+    assert len(np.unique(batch, axis=0)) == 20
+
+
+def test_stratified_draw_from_frame():
+    df = pd.DataFrame(dict(a=[1, 1, 2, 2, 1, 1], b=[0, 0, 0, 0, 1, 1]))
+    draw = StratifiedDraw.from_frame(df, ['a', 'b'])
+    assert_array_equal(draw.strata, [0, 0, 2, 2, 1, 1])
+    df = pd.DataFrame(dict(a=[2, np.nan, 1, 2, np.nan, 1],
+                           b=['y', 'x', None, 'x', 'x', 'y']))
+    assert_array_equal(StratifiedDraw.from_frame(df, ['a', 'b']).strata,
+                       [3, 4, 1, 2, 4, 0])
+    assignment = draw(.5, 6, np.random.default_rng(1))
+    assert_array_equal(np.sort(assignment.reshape(3, 2), axis=1),
+                       [[0, 1]] * 3)
@@ -1,3 +1,6 @@
+from functools import partial
+import pickle
+
 import pandas as pd
 import numpy as np
 from parameterized import parameterized
@@ -6,9 +9,12 @@ from numpy.testing import TestCase, assert_array_almost_equal, \
 
 from ..balance import BalanceObjective, MahalanobisBalance, \
     PValueBalance, BlockBalance, min_across_covariates, identity, \
-    pvalues_report, max_absolute_value, max_across_covariates
+    pvalues_report, max_absolute_value, max_across_covariates, \
+    pvalue_balance, block_balance, arm_category_counts, mahalanobis_balance, \
+    CovariateData, SwapBalance, shared_arguments, arm_masks
 
 from ..utils import NumericFunction
+from ..assignment import get_assignments_as_positions, LabelBatch
 
 
 class TestBalance(TestCase):
@@ -39,6 +45,98 @@ class TestBalance(TestCase):
                 self.df, [np.array([0, 0, 0, 0, 1, 1, 1, 1, 0, 1])]),
             [[0, 0, 0, 0, 1, 1, 1, 1, 0, 1], [1, 1, 1, 1, 0, 0, 0, 0, 1, 0]])
 
+    def test_positions_as_masks(self):
+        labels = np.array([0, 1, 1, 2, 0, 2, 1, 0, 0, 1])
+        positions = get_assignments_as_positions(labels)
+        shifted = self.df.set_index(self.df.index + 100)
+        assert_array_equal(
+            BalanceObjective.assignment_indices(shifted, positions),
+            [labels == arm for arm in range(3)])
+        for balance in [mahalanobis_balance(), pvalue_balance(),
+                        block_balance()]:
+            assert_array_almost_equal(balance(shifted, positions),
+                                      balance.batch(self.df, labels))
+
+    @parameterized.expand([[identity, [0, 1, 0, 1, 1, 0, 0, 1, 1, 0]],
+                           [np.max, [0, 1, 2, 1, 1, 0, 2, 1, 2, 0]]])
+    def test_swap_balance(self, aggregator, labels):
+        maha = MahalanobisBalance(aggregator)
+        swaps = maha.swap_balance(self.df, labels)
+        batch = partial(maha.balance_func.batch, self.df)
+        first, second = np.array([0, 1, 2, 3]), np.array([1, 2, 8, 9])
+        assert_array_almost_equal(
+            swaps.scores(first, second),
+            SwapBalance(batch, labels).scores(first, second))
+        swaps.swap(0, 1)
+        assert_array_equal(swaps.labels[:2], labels[1::-1])
+        assert_almost_equal(swaps.balance, batch([swaps.labels])[0])
+        assert maha.swap_balance(self.df.mask(self.df > .9), labels) is None
+
+    def test_covariate_data(self):
+        data = CovariateData(self.df)
+        assert CovariateData.of(data) is data
+        assert data.values(['a']) is data.values(['a'])
+        assert_array_almost_equal(data.centered(['a', 'b']).mean(axis=0), 0)
+        d = np.array([.1, -.2])
+        assert_almost_equal(
+            np.sum((d @ data.whitening(['a', 'b'])) ** 2),
+            d @ np.linalg.inv(self.df.cov()) @ d)
+
+    def test_numeric_columns(self):
+        df = self.df.assign(site=list('xyzxyzxyzx'))
+        labels = np.random.RandomState(1).choice(2, size=(5, 10))
+        positions = get_assignments_as_positions(labels[0])
+        for balance in [mahalanobis_balance, pvalue_balance]:
+            assert_array_almost_equal(balance()(df, positions),
+                                      balance()(self.df, positions))
+            assert_array_almost_equal(balance().batch(df, labels),
+                                      balance().batch(self.df, labels))
+        combined = mahalanobis_balance() - block_balance(['site'])
+        assert_array_almost_equal(
+            combined.batch(df, labels),
+            [float(combined(df, get_assignments_as_positions(a)).values)
+             for a in labels])
+        assert_array_equal(pvalues_report(df, positions).columns, ['a', 'b'])
+
+    def test_prepare(self):
+        assignments = [self.assignment, [2, 3]]
+        balance = mahalanobis_balance(['a']) + pvalue_balance() \
+            - .5 * block_balance(['a'])
+        prepared = balance.prepare(self.df)
+        assert isinstance(prepared, NumericFunction)
+        assert_array_almost_equal(
+            prepared(assignments), balance(self.df, assignments))
+        labels = np.random.RandomState(1).choice(3, size=(5, 10))
+        assert_array_almost_equal(
+            prepared.batch(labels), balance.batch(self.df, labels))
+
+    def test_shared_state(self):
+        balance = mahalanobis_balance(['a']) + pvalue_balance() \
+            - .5 * block_balance(['a'])
+        prepared = balance.prepare(self.df)
+        data = prepared.leaves()[0].func.args[0]
+        assert isinstance(data, CovariateData)
+        assert all(leaf.func.args[0] is data for leaf in prepared.leaves())
+        labels = np.random.RandomState(1).choice(3, size=(5, 10))
+        shared = prepared.shared((labels,))
+        assert list(shared) == [shared_arguments]
+        batch = shared[shared_arguments][0]
+        assert isinstance(batch, LabelBatch)
+        assert next(arm_masks(batch)) is batch.masks[0]
+        restored = pickle.loads(pickle.dumps(prepared))
+        assert_array_almost_equal(restored.batch(labels),
+                                  balance.batch(self.df, labels))
+
+    def test_prepare_custom_objective(self):
+        class CountBalance(BalanceObjective):
+            def _balance_func(self, df, assignments):
+                assert isinstance(df, pd.DataFrame)
+                return -abs(len(assignments[0]) - len(df) / 2)
+
+        prepared = CountBalance().balance_func.prepare(self.df)
+        assert prepared([self.assignment]) == 0
+        assert prepared.batch_func is None
+
     def test_mahalanobis_id(self):
         maha = MahalanobisBalance().balance_func
         assert isinstance(maha, NumericFunction)
@@ -53,12 +151,60 @@ class TestBalance(TestCase):
         assert_almost_equal(
             maha_max(self.df, [self.assignment, [2, 3]]), [-1.1719512])
 
+    def test_mahalanobis_batch(self):
+        assignments = np.random.RandomState(1).choice(3, size=(5, 10))
+        for agg in [np.max, np.min, np.mean]:
+            maha = MahalanobisBalance(agg).balance_func
+            expected = [float(maha(
+                self.df, get_assignments_as_positions(a)).values)
+                for a in assignments]
+            assert_array_almost_equal(
+                maha.batch(self.df, assignments), expected)
+
+    def test_mahalanobis_batch_combined(self):
+        assignments = np.random.RandomState(1).choice(2, size=(5, 10))
+        maha = MahalanobisBalance(np.max, cols=['a']).balance_func
+        combined = maha - .5 * MahalanobisBalance(np.max).balance_func
+        expected = [float(combined(
+            self.df, get_assignments_as_positions(a)).values)
+            for a in assignments]
+        assert_array_almost_equal(
+            combined.batch(self.df, assignments), expected)
+
     def test_pvalues(self):
         pv_balance = PValueBalance().balance_func
         assert_array_almost_equal(
             pv_balance(self.df, [self.assignment, [2, 3]]),
             [[0.320395, 0.523023], [0.892326, 0.790063]])
 
+    def test_complementary_assignment_many_arms(self):
+        idxs = BalanceObjective.assignment_indices(
+            self.df, [[0, 1], [2, 3], [4]])
+        assert len(idxs) == 4
+        assert_array_almost_equal(
+            idxs[2], [0, 0, 0, 0, 1, 0, 0, 0, 0, 0])
+
+    def test_pvalues_match_ols(self):
+        df = self.df.copy()
+        df.loc[3, 'b'] = np.nan
+        balance = PValueBalance()
+        for assignments in [[self.assignment], [[0, 1, 2], [3, 4, 5, 6]],
+                            [[0, 1, 2], [3, 4, 5, 6], [7, 8, 9]]]:
+            expected = dict((col, balance.pvalues_by_col(
+                col, df, assignments)) for col in ['a', 'b'])
+            assert_array_almost_equal(
+                balance.balance_func(df, assignments),
+                pd.DataFrame(expected), decimal=10)
+
+    def test_pvalues_batch(self):
+        assignments = np.random.RandomState(1).choice(3, size=(5, 10))
+        pv_balance = pvalue_balance()
+        expected = [float(pv_balance(
+            self.df, get_assignments_as_positions(a)).values)
+            for a in assignments]
+        assert_array_almost_equal(
+            pv_balance.batch(self.df, assignments), expected)
+
     @parameterized.expand([
         [np.min, min_across_covariates, 0.320395],
         [identity, min_across_covariates, [0.320395, 0.790063]],
@@ -103,6 +249,22 @@ class TestBalance(TestCase):
             block_res, [[-.5, -1], [-.5, -1.]]
         )
 
+    def test_arm_category_counts(self):
+        counts = arm_category_counts(
+            np.array([0, 1, 1, 2, -1]), 3, [[0, 0, 1, 1, 0], [1, 1, 1, 0, 0]])
+        assert_array_equal(counts[:, 0], [[1, 1, 0], [0, 1, 1]])
+        assert_array_equal(counts[:, 1], [[0, 0, 1], [1, 2, 0]])
+
+    def test_block_balance_batch(self):
+        assignments = np.random.RandomState(1).choice(3, size=(5, 10))
+        df_cat = self.df_cat.copy()
+        df_cat['cat3'] = np.arange(10) % 7
+        block = block_balance()
+        expected = [float(block(
+            df_cat, get_assignments_as_positions(a)).values)
+            for a in assignments]
+        assert_array_almost_equal(block.batch(df_cat, assignments), expected)
+
     @parameterized.expand([
         [max_absolute_value, np.max, identity, [[-.5, -1]]],
         [np.abs, np.max, identity, [[-0, -.25], [-.5, -1], [-.5, np.NAN]]],
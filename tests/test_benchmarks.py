@@ -0,0 +1,37 @@
+import json
+import tempfile
+from os import path
+
+from numpy.testing import TestCase
+
+from ..benchmarks.suite import cases, run_case, compare, main, BASE_CASE, \
+    GRIDS
+
+
+class TestBenchmarks(TestCase):
+    def test_cases(self):
+        grid = dict(n=[100, 1000], arms=[2, 3])
+        all_cases = cases(grid)
+        assert dict(BASE_CASE, design='krct', objective='block', n=100) \
+            in all_cases
+        assert len(all_cases) == 3 * (1 + 4 * 2)
+        assert all(len(cases(g)) == len(set(
+            tuple(sorted(c.items())) for c in cases(g)))
+            for g in GRIDS.values())
+
+    def test_run_and_compare(self):
+        case = dict(BASE_CASE, design='krct', objective='mixed', n=50, p=3,
+                    k=20)
+        result = run_case(case)
+        assert result['seconds'] > 0 and result['peak_mb'] > 0
+        slower = dict(result, seconds=2 * result['seconds'])
+        ratios, regressions = compare(
+            dict(results=[result]), dict(results=[slower, result]))
+        assert len(ratios) == 2 and len(regressions) == 1
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [path.join(tmp, name) for name in ['old', 'new']]
+            for file, res in zip(files, [result, slower]):
+                with open(file, 'w') as fh:
+                    json.dump(dict(results=[res]), fh)
+            assert main(['compare'] + files) == 1
+            assert main(['compare', files[0], files[0]]) == 0
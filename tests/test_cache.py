@@ -0,0 +1,96 @@
+from os import path
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from numpy.testing import TestCase, assert_array_equal
+
+from ..cache import fingerprint, ResultCache
+from ..design import KRerandomizedRCT, QuantileTargetingRCT, \
+    ThresholdRerandomizedRCT
+from ..balance import MahalanobisBalance, mahalanobis_balance, \
+    block_balance
+
+
+class TestFingerprint(TestCase):
+    def test_fingerprint(self):
+        assert fingerprint(mahalanobis_balance() - block_balance(['C'])) == \
+            fingerprint(mahalanobis_balance() - block_balance(['C']))
+        assert fingerprint(mahalanobis_balance(['A'])) != \
+            fingerprint(mahalanobis_balance(['B']))
+        assert fingerprint(lambda x: x) != fingerprint(lambda x: 2 * x)
+        df = pd.DataFrame(dict(a=[1., 2.]))
+        assert fingerprint(df) == fingerprint(df.copy())
+        assert fingerprint(df) != fingerprint(df + 1)
+        assert fingerprint(dict(a=np.arange(3), b=[.5])) == \
+            fingerprint(dict(b=[.5], a=np.arange(3)))
+
+
+class TestResultCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_memory(self):
+        cache = ResultCache(max_memory_bytes=2000)
+        for key in 'abc':
+            cache.put(key, dict(assignment=np.zeros(100), score=None))
+        assert cache.get('a') is None
+        assert set(cache.get('c')) == {'assignment'}
+        assert_array_equal(cache.get('b')['assignment'], np.zeros(100))
+
+    def test_disk(self):
+        cache = ResultCache(self.dir.name, max_bytes=2500)
+        for i, key in enumerate('abc'):
+            cache.put(key, dict(assignment=np.full(100, i)))
+            os.utime(cache.path(key), (i, i))
+        assert sorted(os.listdir(self.dir.name)) == ['b.npz', 'c.npz']
+        reopened = ResultCache(self.dir.name)
+        assert_array_equal(reopened.get('b')['assignment'], np.ones(100))
+        assert reopened.get('a') is None
+        reopened.clear()
+        assert os.listdir(self.dir.name) == []
+
+    def test_design(self):
+        def design(seed=0, cache=None):
+            return KRerandomizedRCT(
+                MahalanobisBalance(), self.file, [.5, .5], k=30, seed=seed
+            ).use_cache(cache or ResultCache(self.dir.name)).instrument()
+
+        first = design()
+        expected = first.assignment_from_shuffled
+        scores = first.scores
+        assert len(scores) == 30
+        second = design()
+        assert_array_equal(second.assignment_from_shuffled, expected)
+        assert_array_equal(second.scores, scores)
+        assert second.stats.counters == dict(cache_hits=1)
+        assert_array_equal(
+            second.assignment_from_shuffled,
+            KRerandomizedRCT(MahalanobisBalance(), self.file, [.5, .5],
+                             k=30).assignment_from_shuffled)
+        other = design(seed=1)
+        other.assignment_from_shuffled
+        assert 'cache_hits' not in other.stats.counters
+        assert design(cache=ResultCache(
+            self.dir.name, store_scores=False)).scores is None
+
+    def test_design_attributes(self):
+        cache = ResultCache()
+        designs = [ThresholdRerandomizedRCT(
+            mahalanobis_balance(), self.file, [.5, .5], quantile_target=.1,
+            num_pilot=20, max_draws=200).use_cache(cache) for _ in range(2)]
+        expected = designs[0].assignment_from_iid
+        assert_array_equal(designs[1].assignment_from_iid, expected)
+        for name in ['acceptance_threshold', 'num_draws', 'accepted']:
+            assert getattr(designs[1], name) == getattr(designs[0], name)
+        assert len(designs[1].scores) == designs[0].num_draws
+        quantile = QuantileTargetingRCT(
+            mahalanobis_balance(), self.file, [.5, .5], .1,
+            num_monte_carlo=50).use_cache(cache)
+        assert quantile.cache_key(len) != designs[0].cache_key(len)
@@ -0,0 +1,76 @@
+from os import path
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from parameterized import parameterized
+from numpy.testing import TestCase, assert_array_equal
+
+from ..design import KRerandomizedRCT, QuantileTargetingRCT
+from ..balance import mahalanobis_balance, block_balance
+from ..assignment import get_assignments_as_positions
+from ..cli import parse_objective, main
+
+
+class TestCli(TestCase):
+    def setUp(self):
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+        self.dir = tempfile.TemporaryDirectory()
+        self.input = path.join(self.dir.name, 'input')
+        self.output = path.join(self.dir.name, 'output')
+        os.makedirs(self.input)
+        for name in ['a.csv', 'b.csv']:
+            shutil.copy(self.file, path.join(self.input, name))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_parse_objective(self):
+        df = pd.read_csv(self.file)
+        assignments = [get_assignments_as_positions(pd.DataFrame(
+            dict(t=labels))) for labels in
+            np.random.RandomState(0).randint(2, size=(5, 100))]
+        objective, columns = parse_objective('mahalanobis:A,B - 2*block:C')
+        assert columns == ['A', 'B', 'C']
+        expected = mahalanobis_balance(['A', 'B']) - 2 * block_balance(['C'])
+        assert_array_equal(
+            [objective(df, a) for a in assignments],
+            [expected(df, a) for a in assignments])
+        assert parse_objective('-pvalue + block:C')[1] is None
+        for spec in ['', 'maha:A', 'mahalanobis block', 'pvalue:A * 2']:
+            with self.assertRaises(ValueError):
+                parse_objective(spec)
+
+    @parameterized.expand([[1], [2]])
+    def test_directory(self, n_jobs):
+        assert main(['assign', self.input, '-k', '50', '--objective',
+                     'mahalanobis:A,B', '--n-jobs', str(n_jobs),
+                     '--output', self.output]) == 0
+        assert sorted(os.listdir(self.output)) == sorted(
+            '{}.{}'.format(stem, name) for stem in 'ab' for name in
+            ['assignment.csv', 'balance.csv', 'stats.json'])
+        expected = KRerandomizedRCT(
+            mahalanobis_balance(['A', 'B']), self.file, [.5, .5], k=50,
+            n_jobs=1).assignment_from_iid
+        for stem in 'ab':
+            assert_array_equal(pd.read_csv(path.join(
+                self.output, stem + '.assignment.csv'), index_col=0),
+                expected)
+
+    def test_single_file(self):
+        assert main(['assign', path.join(self.input, 'a.csv'), '--design',
+                     'qrct', '-k', '50', '--quantile', '.1', '--scheme',
+                     'shuffled', '--weights', '.3', '.7', '--seed', '3',
+                     '--output', self.output]) == 0
+        expected = QuantileTargetingRCT(
+            mahalanobis_balance(), self.file, [.3, .7], .1, seed=3,
+            num_monte_carlo=50).assignment_from_shuffled
+        assert_array_equal(pd.read_csv(path.join(
+            self.output, 'a.assignment.csv'), index_col=0), expected)
+        report = pd.read_csv(path.join(self.output, 'a.balance.csv'),
+                             index_col=0)
+        assert list(report.index) == ['t1']
+        assert list(report.columns) == ['A', 'B', 'C']
@@ -1,10 +1,18 @@
+import numpy as np
 import pandas as pd
-from numpy.testing import TestCase, assert_array_almost_equal
+from numpy.testing import TestCase, assert_array_almost_equal, \
+    assert_array_equal
 from os import path
+from itertools import islice
+from parameterized import parameterized
 
-from ..design import RCT, KRerandomizedRCT, QuantileTargetingRCT
-from ..balance import MahalanobisBalance, pvalues_report
-from ..assignment import get_assignments_as_positions
+from ..design import RCT, KRerandomizedRCT, QuantileTargetingRCT, \
+    ThresholdRerandomizedRCT, SwapSearchRCT, CohortBatch, \
+    BalanceDistribution, DRAW_SCHEMES
+from ..balance import MahalanobisBalance, pvalues_report, \
+    mahalanobis_balance, MahalanobisSwapBalance, SwapBalance
+from ..assignment import get_assignments_as_positions, draw_iid_assignment, \
+    draw_shuffled_assignment
 
 
 class TestRCT(TestCase):
@@ -102,6 +110,105 @@ class TestKRerandomized(TestCase):
                     self.krerand.assignment_from_shuffled)),
             [[0.719567, 0.895064, 0.842654]])
 
+    def test_batch_matches_single_draws(self):
+        single = KRerandomizedRCT(
+            lambda df, a: self.maha.balance_func(df, a), self.file, [.3, .7],
+            k=30)
+        batched = KRerandomizedRCT(self.maha, self.file, [.3, .7], k=30)
+        assert not single.supports_batch
+        assert batched.supports_batch
+        assert_array_equal(single.assignment_from_iid,
+                           batched.assignment_from_iid)
+        assert_array_equal(single.assignment_from_shuffled,
+                           batched.assignment_from_shuffled)
+
+    def test_parallel_independent_of_n_jobs(self):
+        designs = [KRerandomizedRCT(self.maha, self.file, [.3, .7], k=2500,
+                                    n_jobs=n_jobs) for n_jobs in [1, 2, 3]]
+        assert designs[0].n_streams == 3
+        for assignments in [[d.assignment_from_iid for d in designs],
+                            [d.assignment_from_shuffled for d in designs]]:
+            assert_array_equal(assignments[0], assignments[1])
+            assert_array_equal(assignments[0], assignments[2])
+        assert_array_almost_equal(
+            designs[0].assignment_from_shuffled.mean(), .7)
+
+    def test_parallel_single_draws(self):
+        single = KRerandomizedRCT(
+            lambda df, a: self.maha.balance_func(df, a), self.file, [.3, .7],
+            k=30, n_jobs=2)
+        batched = KRerandomizedRCT(
+            self.maha, self.file, [.3, .7], k=30, n_jobs=1)
+        assert_array_equal(single.assignment_from_iid,
+                           batched.assignment_from_iid)
+
+    def test_indexed_draws(self):
+        design = KRerandomizedRCT(self.maha, self.file, [.3, .7], k=50,
+                                  legacy_rng=False)
+        parallel = KRerandomizedRCT(self.maha, self.file, [.3, .7], k=50,
+                                    n_jobs=1)
+        best = design.assignment_from_shuffled
+        assert_array_equal(best, design.assignment_from_shuffled)
+        assert_array_equal(best, parallel.assignment_from_shuffled)
+        assert any((best.t == design.draw(draw_shuffled_assignment, i)).all()
+                   for i in range(50))
+
+    def test_stratified(self):
+        maha = MahalanobisBalance(cols=['A', 'B'])
+        designs = [KRerandomizedRCT(
+            objective, self.file, [.5, .5], k=20, strata=['C'])
+            for objective in [maha, lambda df, a: maha.balance_func(df, a)]]
+        assert designs[0].supports_batch and not designs[1].supports_batch
+        assert list(designs[0].df.columns) == ['A', 'B', 'C']
+        best = designs[0].assignment_from_stratified
+        assert_array_equal(best, designs[1].assignment_from_stratified)
+        counts = pd.crosstab(designs[0].df.C, best.t).values
+        assert (np.abs(counts[:, 0] - counts[:, 1]) <= 1).all()
+        assert len(designs[0].balance_distribution('stratified')) == 20
+        with self.assertRaises(ValueError):
+            KRerandomizedRCT(self.maha, self.file, .5).stratified_draw
+
+    @parameterized.expand([['iid', None], ['shuffled', None],
+                           ['shuffled', 1]])
+    def test_balance_distribution(self, scheme, n_jobs):
+        design = KRerandomizedRCT(self.maha, self.file, [.3, .7], k=40,
+                                  n_jobs=n_jobs)
+        distribution = design.balance_distribution(scheme)
+        assert len(distribution) == 40
+        assert distribution.rank == 1
+        assert_array_almost_equal(distribution.selected,
+                                  np.max(distribution))
+        loop = [design.balance(a) for a in design.draws(DRAW_SCHEMES[scheme])]
+        if n_jobs is None:
+            assert_array_almost_equal(distribution, loop)
+        quantiles = distribution.quantiles([0, .5, 1])
+        assert_array_almost_equal(
+            quantiles, np.quantile(np.asarray(distribution), [0, .5, 1]))
+
+    @parameterized.expand([[None], [1], [2]])
+    def test_instrument(self, n_jobs):
+        design = KRerandomizedRCT(self.maha, self.file, [.3, .7], k=30,
+                                  n_jobs=n_jobs)
+        assert not design.stats.enabled
+        expected = design.assignment_from_shuffled
+        progress = []
+        assert design.instrument(
+            lambda done, total: progress.append((done, total))) is design
+        best = design.assignment_from_shuffled
+        assert_array_equal(best, expected)
+        counters = best.attrs['stats']['counters']
+        assert counters['draws'] == counters['evaluations'] == 30
+        assert {'draw', 'objective'} <= set(best.attrs['stats']['times'])
+        assert progress[-1] == (30, 30)
+
+    def test_instrument_single_draws(self):
+        design = KRerandomizedRCT(
+            lambda df, a: self.maha.balance_func(df, a), self.file, [.3, .7],
+            k=20).instrument()
+        design.assignment_from_iid
+        assert design.stats.counters == dict(draws=20, evaluations=20)
+        assert {'draw', 'convert', 'objective'} <= set(design.stats.times)
+
 
 class TestQuantileTargetingRCT(TestCase):
     def setUp(self):
@@ -134,6 +241,66 @@ class TestQuantileTargetingRCT(TestCase):
             self.qt_rct.assignment_from_shuffled[:10].T,
             [[0, 1, 1, 1, 0, 1, 0, 1, 1, 0]])
 
+    def test_batch_matches_single_draws(self):
+        single = QuantileTargetingRCT(
+            lambda df, a: self.maha.balance_func(df, a), self.file, [.3, .7],
+            .1, num_monte_carlo=50)
+        assert not single.supports_batch
+        assert self.qt_rct.supports_batch
+        batched = QuantileTargetingRCT(
+            self.maha, self.file, [.3, .7], .1, num_monte_carlo=50)
+        assert_array_equal(single.assignment_from_iid,
+                           batched.assignment_from_iid)
+        assert_array_equal(single.assignment_from_shuffled,
+                           batched.assignment_from_shuffled)
+
+    def test_indexed_draws(self):
+        designs = [QuantileTargetingRCT(
+            self.maha, self.file, [.3, .7], .1, num_monte_carlo=50,
+            legacy_rng=False) for _ in range(2)]
+        assert_array_equal(designs[0].assignment_from_iid,
+                           designs[1].assignment_from_iid)
+        assert_array_equal(designs[0].redraw(draw_iid_assignment, 7),
+                           designs[1].draw(draw_iid_assignment, 7))
+        assert not np.array_equal(designs[0].draw(draw_iid_assignment, 7),
+                                  designs[0].draw(draw_iid_assignment, 8))
+
+    def test_instrument(self):
+        expected = self.qt_rct.assignment_from_iid
+        progress = []
+        best = self.qt_rct.instrument(
+            lambda done, total: progress.append(done)).assignment_from_iid
+        assert_array_equal(best, expected)
+        assert best.attrs['stats']['counters'] == dict(
+            draws=100, evaluations=100, retained_candidates=5)
+        assert {'draw', 'select', 'redraw'} <= set(self.qt_rct.stats.times)
+        assert progress[-1] == 100
+
+    def test_balance_distribution(self):
+        single = QuantileTargetingRCT(
+            lambda df, a: self.maha.balance_func(df, a), self.file, [.5, .5],
+            .05, num_monte_carlo=100)
+        distributions = [design.balance_distribution('shuffled')
+                         for design in [self.qt_rct, single]]
+        assert_array_almost_equal(distributions[0], distributions[1])
+        assert 1 <= distributions[0].rank <= 5
+        assert distributions[0].rank == distributions[1].rank
+        assert distributions[0].selected_draw == \
+            distributions[1].selected_draw
+        assert_array_almost_equal(distributions[0].selected,
+                                  distributions[1].selected)
+
+    def test_small_balance_rank(self):
+        scores = [-1e-9, -2e-9, -5e-9, -3e-9]
+        assert BalanceDistribution(scores, -5e-9).rank == 4
+        assert BalanceDistribution(scores, None, 2).rank == 4
+        assert BalanceDistribution(scores + [-5e-9], None, 4).rank == 4
+
+    def test_legacy_redraw(self):
+        draws = list(self.qt_rct.draws(draw_shuffled_assignment))
+        assert_array_equal(
+            self.qt_rct.redraw(draw_shuffled_assignment, 42), draws[42])
+
     def test_iid_balance(self):
         assert_array_almost_equal(
             pvalues_report(
@@ -145,3 +312,152 @@ class TestQuantileTargetingRCT(TestCase):
             pvalues_report(self.qt_rct.df,
                            self.qt_rct.assignment_from_shuffled),
             [[0.82268, 0.82947, 0.551186]])
+
+
+class TestThresholdRerandomizedRCT(TestCase):
+    def setUp(self):
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+        self.maha = MahalanobisBalance()
+
+    def test_threshold(self):
+        for legacy_rng in [True, False]:
+            design = ThresholdRerandomizedRCT(
+                self.maha, self.file, [.5, .5], threshold=-.01,
+                max_draws=500, legacy_rng=legacy_rng)
+            assignment = design.assignment_from_shuffled
+            assert design.accepted
+            assert 1 < design.num_draws < 500
+            assert design.balance(assignment) >= -.01
+            assert_array_equal(assignment.t, design.redraw(
+                draw_shuffled_assignment, design.num_draws - 1))
+            assert_array_equal(assignment, design.assignment_from_shuffled)
+
+    def test_pilot_quantile(self):
+        design = ThresholdRerandomizedRCT(
+            self.maha, self.file, [.3, .7], quantile_target=.05,
+            num_pilot=100, max_draws=1000)
+        assignment = design.assignment_from_iid
+        pilot = [design.balance(a) for a in islice(
+            design.draws(draw_iid_assignment), 100)]
+        assert_array_almost_equal(design.acceptance_threshold,
+                                  sorted(pilot)[-5])
+        assert design.accepted and design.num_draws > 100
+        assert design.balance(assignment) >= design.acceptance_threshold
+
+    def test_max_draws(self):
+        design = ThresholdRerandomizedRCT(
+            self.maha, self.file, [.5, .5], threshold=0, max_draws=200)
+        krerand = KRerandomizedRCT(self.maha, self.file, [.5, .5], k=200)
+        assert_array_equal(design.assignment_from_iid,
+                           krerand.assignment_from_iid)
+        assert not design.accepted
+        assert design.num_draws == 200
+
+    def test_single_draws(self):
+        single = ThresholdRerandomizedRCT(
+            lambda df, a: self.maha.balance_func(df, a), self.file, [.3, .7],
+            quantile_target=.1, num_pilot=20, max_draws=300)
+        batched = ThresholdRerandomizedRCT(
+            self.maha, self.file, [.3, .7], quantile_target=.1, num_pilot=20,
+            max_draws=300)
+        assert_array_equal(single.assignment_from_iid,
+                           batched.assignment_from_iid)
+        assert single.num_draws == batched.num_draws
+
+    def test_invalid_threshold(self):
+        with self.assertRaises(ValueError):
+            ThresholdRerandomizedRCT(self.maha, self.file, [.5, .5])
+        with self.assertRaises(ValueError):
+            ThresholdRerandomizedRCT(self.maha, self.file, [.5, .5], -1, .1)
+        with self.assertRaises(ValueError):
+            ThresholdRerandomizedRCT(self.maha, self.file, [.5, .5],
+                                     quantile_target=.1, num_pilot=0)
+
+
+class TestSwapSearchRCT(TestCase):
+    def setUp(self):
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+        self.maha = MahalanobisBalance()
+
+    def test_improves_balance(self):
+        design = SwapSearchRCT(self.maha, self.file, [.3, .7], num_restarts=3,
+                               max_moves=200)
+        assignment = design.assignment_from_shuffled
+        starts = [design.balance(a) for a in design.draws(
+            draw_shuffled_assignment)]
+        assert all(design.balances > starts)
+        assert_array_almost_equal(design.balance(assignment),
+                                  design.balances.max())
+        assert_array_almost_equal(assignment.mean(), .7)
+        assert_array_equal(assignment, design.assignment_from_shuffled)
+
+    def test_incremental_swaps(self):
+        designs = [SwapSearchRCT(objective, self.file, [.3, .7],
+                                 num_restarts=2, max_moves=50)
+                   for objective in [mahalanobis_balance(),
+                                     MahalanobisBalance(np.max)]]
+        labels = designs[0].draw(draw_shuffled_assignment, 0)
+        for design in designs:
+            assert isinstance(design.swap_balance(labels),
+                              MahalanobisSwapBalance)
+        assert_array_equal(designs[0].assignment_from_shuffled,
+                           designs[1].assignment_from_shuffled)
+        assert type(SwapSearchRCT(
+            mahalanobis_balance() - 1, self.file, [.3, .7]).swap_balance(
+            labels)) is SwapBalance
+
+    def test_near_optimal_choice(self):
+        design = SwapSearchRCT(self.maha, self.file, [.5, .5], num_restarts=8,
+                               max_moves=20, tolerance=1., legacy_rng=False)
+        selected = design.search_rng(8).choice(8)
+        assert_array_almost_equal(
+            design.balance(design.assignment_from_iid),
+            design.balances[selected])
+        assert design.balances[selected] < design.balances.max()
+
+    def test_single_draws(self):
+        design = SwapSearchRCT(
+            lambda df, a: self.maha.balance_func(df, a), self.file, [.5, .5],
+            num_restarts=2, max_moves=10, num_candidates=8)
+        assert not design.supports_batch
+        assignment = design.assignment_from_iid
+        assert design.balance(assignment) == design.balances.max()
+
+
+class TestCohortBatch(TestCase):
+    def setUp(self):
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+        df = pd.read_csv(self.file)
+        self.cohorts = dict(file=self.file, head=df.iloc[:40],
+                            tail=df.iloc[40:].reset_index(drop=True))
+        self.maha = MahalanobisBalance(cols=['A', 'B'])
+
+    @parameterized.expand([[None, 'iid'], [2, 'shuffled'], [3, 'stratified']])
+    def test_assignments(self, n_jobs, scheme):
+        batch = CohortBatch(self.maha, self.cohorts, [.5, .5], k=1500,
+                            seed=2, n_jobs=n_jobs, strata=['C']).instrument()
+        assignments = batch.assignments(scheme)
+        assert list(assignments) == ['file', 'head', 'tail']
+        for name, cohort in self.cohorts.items():
+            design = KRerandomizedRCT(self.maha, cohort, [.5, .5], k=1500,
+                                      seed=2, n_jobs=1, strata=['C'])
+            assert_array_equal(
+                assignments[name],
+                getattr(design, 'assignment_from_{}'.format(scheme)))
+            assert_array_equal(batch.scores[name], design.scores)
+            assert batch.stats[name].counters['draws'] == 1500
+            assert assignments[name].attrs['stats']['counters'] == \
+                batch.stats[name].counters
+        assert [design.seed for design in batch.designs] == \
+            [KRerandomizedRCT(self.maha, self.file, [.5, .5], seed=2).seed,
+             2, 2]
+
+    def test_work_units(self):
+        batch = CohortBatch(self.maha, list(self.cohorts.values()), [.5, .5],
+                            k=1500)
+        assert batch.names == [0, 1, 2]
+        assert batch.work_units() == [(0, 0), (2, 0), (0, 1), (1, 0),
+                                      (2, 1), (1, 1)]
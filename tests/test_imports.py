@@ -0,0 +1,43 @@
+from os import path
+import json
+import subprocess
+import sys
+
+from numpy.testing import TestCase
+
+PACKAGE = __name__.rsplit('.', 2)[0]
+# seconds to import the modules of the package once numpy and pandas are
+# loaded; statsmodels and scipy alone take several times as long
+IMPORT_BUDGET = .25
+SCRIPT = """
+import json, sys, time
+import numpy, pandas, lazy_property
+start = time.perf_counter()
+import {package}.design, {package}.cli
+seconds = time.perf_counter() - start
+modules = [name for name in ['scipy', 'statsmodels', 'patsy']
+           if name in sys.modules]
+print(json.dumps(dict(seconds=seconds, modules=modules)))
+"""
+
+
+class TestImports(TestCase):
+    def import_stats(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT.format(package=PACKAGE)],
+            cwd=path.dirname(path.dirname(path.dirname(
+                path.abspath(__file__)))))
+        return json.loads(output)
+
+    def test_lazy_imports(self):
+        stats = self.import_stats()
+        assert stats['modules'] == []
+        assert stats['seconds'] < IMPORT_BUDGET
+
+    def test_submodules(self):
+        package = sys.modules[PACKAGE]
+        assert package.design.RCT.__name__ == 'RCT'
+        assert {'balance', 'utils', 'assignment', 'design'} <= set(
+            dir(package))
+        with self.assertRaises(AttributeError):
+            package.missing
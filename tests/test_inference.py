@@ -0,0 +1,53 @@
+from os import path
+
+import numpy as np
+from numpy.testing import TestCase, assert_array_equal
+
+from ..design import RCT, KRerandomizedRCT
+from ..balance import mahalanobis_balance
+from ..inference import RandomizationInference
+
+
+class TestRandomizationInference(TestCase):
+    def setUp(self):
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+        self.design = KRerandomizedRCT(mahalanobis_balance(), self.file,
+                                       [.5, .5], k=20)
+        self.assignment = self.design.assignment_from_iid.t.values
+        self.noise = np.random.RandomState(0).randn(100)
+
+    def test_effect(self):
+        outcomes = self.design.df.A + 1.5 * self.assignment + self.noise
+        inference = RandomizationInference(
+            self.design, outcomes, self.assignment, num_replications=100)
+        assert inference.pvalues()['t1'] == 1 / 101
+        assert inference.pvalues(1.5)['t1'] > .05
+        lower, upper = inference.confidence_intervals().loc['t1']
+        assert lower < 1.5 < upper
+        assert lower < inference.estimates['t1'] < upper
+
+    def test_replications(self):
+        inferences = [RandomizationInference(
+            self.design, self.noise, num_replications=10, n_jobs=n_jobs)
+            for n_jobs in [1, 2]]
+        assert_array_equal(inferences[0].assignment, self.assignment)
+        assert_array_equal(inferences[0].replications,
+                           inferences[1].replications)
+        assert_array_equal(inferences[0].replications[3],
+                           inferences[0].replica(3).assignment_from_iid.t)
+        assert len(np.unique(inferences[0].replications, axis=0)) == 10
+        assert self.design.seed == 2705298820
+
+    def test_multiple_arms(self):
+        design = RCT(self.file, [.3, .3, .4], 1)
+        assignment = design.assignment_from_shuffled.t.values
+        outcomes = self.noise - 2. * (assignment == 2)
+        inference = RandomizationInference(
+            design, outcomes, scheme='shuffled', num_replications=100)
+        pvalues = inference.pvalues()
+        assert list(pvalues.index) == ['t1', 't2']
+        assert pvalues['t1'] > .05 > pvalues['t2']
+        intervals = inference.confidence_intervals()
+        assert intervals.loc['t1', 'lower'] < 0 < intervals.loc['t1', 'upper']
+        assert intervals.loc['t2', 'upper'] < 0
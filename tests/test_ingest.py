@@ -0,0 +1,151 @@
+from functools import partial
+from hashlib import md5
+from os import path
+import pickle
+import tempfile
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+from parameterized import parameterized
+from numpy.testing import TestCase, assert_array_almost_equal, \
+    assert_array_equal
+
+from ..ingest import read_covariates, hash_file, CovariateStore, \
+    row_chunks, column_means, column_covariance
+from ..design import RCT, KRerandomizedRCT, SwapSearchRCT
+from ..balance import MahalanobisBalance, arm_masks, arm_sums, \
+    mahalanobis_balance, pvalue_balance, block_balance, CovariateData
+from ..assignment import get_assignments_as_positions
+
+
+class TestIngest(TestCase):
+    def setUp(self):
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+        self.df = pd.read_csv(self.file)
+        with open(self.file, 'rb') as fh:
+            self.md5 = md5(fh.read()).hexdigest()
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_csv(self):
+        df, hasher = read_covariates(self.file)
+        assert hasher.hexdigest() == self.md5
+        pd.testing.assert_frame_equal(df, self.df)
+        df, hasher = read_covariates(self.file, ['A', 'C'])
+        assert hasher.hexdigest() == self.md5
+        pd.testing.assert_frame_equal(df, self.df[['A', 'C']])
+        assert hash_file(self.file).hexdigest() == self.md5
+
+    def test_npy(self):
+        file = path.join(self.dir.name, 'covariates.npy')
+        np.save(file, self.df.values)
+        df, hasher = read_covariates(file, ['x0', 'x2'])
+        assert_array_almost_equal(df.values, self.df[['A', 'C']].values)
+        assert list(df.columns) == ['x0', 'x2']
+        assert hasher.hexdigest() == hash_file(file).hexdigest()
+        np.save(file, self.df.to_records(index=False))
+        df, _ = read_covariates(file, ['B'])
+        pd.testing.assert_frame_equal(df, self.df[['B']])
+
+    def test_parquet(self):
+        pytest.importorskip('pyarrow')
+        file = path.join(self.dir.name, 'covariates.parquet')
+        self.df.to_parquet(file)
+        df, hasher = read_covariates(file, ['B'])
+        pd.testing.assert_frame_equal(df, self.df[['B']])
+        assert hasher.hexdigest() == hash_file(file).hexdigest()
+
+    def test_design_columns(self):
+        rct = RCT(self.file, [.5, .5], 1, columns=['A'])
+        assert rct.seed == 2705298821
+        assert list(rct.df.columns) == ['A']
+        design = KRerandomizedRCT(MahalanobisBalance(cols=['B']), self.file,
+                                  [.5, .5], k=10)
+        assert list(design.df.columns) == ['A', 'B', 'C']
+        design = KRerandomizedRCT(MahalanobisBalance(cols=['B']), self.file,
+                                  [.5, .5], k=10, columns=['B'])
+        assert list(design.df.columns) == ['B']
+        assert design.seed == 2705298820
+
+
+class TestCovariateStore(TestCase):
+    def setUp(self):
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+        self.df = pd.read_csv(self.file)
+        self.store = CovariateStore.from_file(self.file)
+
+    def test_store(self):
+        assert list(self.store.columns) == ['A', 'B', 'C']
+        assert len(self.store) == 100
+        assert self.store.hash_int == RCT(self.file, .5).file_hash_int
+        pd.testing.assert_frame_equal(self.store[['C', 'A']],
+                                      self.df[['C', 'A']].astype(float))
+        assert_array_almost_equal(self.store['B'], self.df['B'])
+        state = pickle.dumps(self.store)
+        assert len(state) < 1000
+        assert_array_almost_equal(
+            pickle.loads(state).column_view(['B'])[10:20],
+            self.df[['B']].values[10:20])
+
+    def test_chunked_sums(self):
+        view = self.store.column_view(['A', 'B'])
+        masks = list(arm_masks(np.arange(100)[None, :] % 3))
+        for got, expected in zip(
+                arm_sums(view, masks, squares=True),
+                arm_sums(self.df[['A', 'B']].values, masks, squares=True)):
+            assert_array_almost_equal(got, expected)
+        assert_array_almost_equal(column_means(view),
+                                  self.df[['A', 'B']].mean())
+        chunks = list(row_chunks(view, 7))
+        assert len(chunks) == 15
+        assert_array_almost_equal(np.concatenate([c for _, c in chunks]),
+                                  self.df[['A', 'B']].values)
+
+    def test_chunked_covariance(self):
+        df = self.df.astype(float)
+        df.iloc[::3, 0] = np.nan
+        df.iloc[::5, 2] = np.nan
+        store = CovariateStore.from_frame(df)
+        for chunk_rows in [7, 1000]:
+            with patch('{}.row_chunks'.format(column_covariance.__module__),
+                       partial(row_chunks, chunk_rows=chunk_rows)):
+                assert_array_almost_equal(
+                    column_covariance(store.column_view(df.columns)),
+                    df.cov())
+        assert_array_almost_equal(
+            CovariateData(store).whitening(['A', 'C']),
+            CovariateData(df).whitening(['A', 'C']))
+
+    @parameterized.expand([[mahalanobis_balance()], [pvalue_balance()],
+                           [block_balance(['C'])]])
+    def test_objectives(self, balance):
+        labels = np.random.RandomState(0).choice(3, size=(4, 100))
+        assert_array_almost_equal(balance.batch(self.store, labels),
+                                  balance.batch(self.df, labels))
+        positions = get_assignments_as_positions(labels[0])
+        assert_array_almost_equal(balance(self.store, positions),
+                                  balance(self.df, positions))
+
+    def test_design(self):
+        designs = [KRerandomizedRCT(mahalanobis_balance(), data, [.3, .7],
+                                    k=30, seed=1)
+                   for data in [self.df, self.store]]
+        assert designs[1].seed == KRerandomizedRCT(
+            mahalanobis_balance(), self.file, [.3, .7], seed=1).seed
+        designs[0].shift_seed = designs[1].seed
+        assert_array_equal(designs[0].assignment_from_iid,
+                           designs[1].assignment_from_iid)
+
+    def test_swap_design(self):
+        designs = [SwapSearchRCT(mahalanobis_balance(), data, [.3, .7],
+                                 num_restarts=2, seed=1)
+                   for data in [self.df, self.store]]
+        designs[0].shift_seed = designs[1].seed
+        assert_array_equal(designs[0].assignment_from_iid,
+                           designs[1].assignment_from_iid)
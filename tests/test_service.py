@@ -0,0 +1,105 @@
+from os import path
+import asyncio
+import tempfile
+import time
+
+import numpy as np
+from numpy.testing import TestCase, assert_array_equal
+
+from ..design import KRerandomizedRCT
+from ..balance import mahalanobis_balance, pvalues_report
+from ..service import AssignmentService, ServiceClient, ServiceError
+
+
+class TestService(TestCase):
+    def setUp(self):
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+        self.design = KRerandomizedRCT(
+            mahalanobis_balance(['A', 'B']), self.file, [.5, .5], k=50,
+            n_jobs=1, columns=['A', 'B'])
+        self.options = dict(k=50, objective='mahalanobis:A,B')
+
+    def run_client(self, test, n_jobs=1, max_pending=64, unix=False,
+                   num_idle=0):
+        async def run():
+            service = AssignmentService(n_jobs, max_pending)
+            with tempfile.TemporaryDirectory() as directory:
+                unix_path = path.join(directory, 'socket') if unix else None
+                address = await service.start(port=0, unix_path=unix_path)
+                idle = [await asyncio.open_connection(port=address[1])
+                        for _ in range(num_idle)]
+                client = await (
+                    ServiceClient.connect(unix_path=unix_path) if unix else
+                    ServiceClient.connect(port=address[1]))
+                try:
+                    return await test(client)
+                finally:
+                    for _, writer in idle:
+                        writer.close()
+                    await client.close()
+                    await service.close()
+        return asyncio.run(run())
+
+    def test_requests(self):
+        async def test(client):
+            return await asyncio.gather(*[
+                client.request(op, self.file, **self.options)
+                for op in ['assign', 'balance_report', 'scores', 'assign']])
+
+        for unix in [False, True]:
+            assignment, report, scores, again = self.run_client(
+                test, n_jobs=2, unix=unix)
+            expected = self.design.assignment_from_iid
+            assert_array_equal(assignment['t'], expected.t)
+            assert assignment['index'] == list(expected.index)
+            assert again['t'] == assignment['t']
+            assert report == pvalues_report(
+                self.design.df, expected).to_dict(orient='index')
+            assert len(scores['scores']) == 50
+            assert scores['rank'] == 1
+            assert np.isclose(scores['selected'], max(scores['scores']))
+
+    def test_warm_designs(self):
+        async def test(client):
+            first = await client.request('assign', self.file, **self.options)
+            second = await client.request('assign', self.file, **self.options)
+            return first['stats'], second['stats']
+
+        first, second = self.run_client(test)
+        assert first['counters']['draws'] == 50
+        assert second['counters'] == dict(cache_hits=1)
+
+    def test_errors(self):
+        async def test(client):
+            errors = []
+            for op, file_path, options in [
+                    ('draw', self.file, {}),
+                    ('assign', 'missing.csv', {}),
+                    ('assign', self.file, dict(unknown=1)),
+                    ('scores', self.file, dict(design='rct'))]:
+                try:
+                    await client.request(op, file_path, **options)
+                except ServiceError as e:
+                    errors.append(str(e))
+            start = time.perf_counter()
+            try:
+                await client.request('assign', self.file, deadline=.01,
+                                     k=20000, seed=1)
+            except ServiceError as e:
+                errors.append(str(e))
+            return errors, time.perf_counter() - start
+
+        errors, seconds = self.run_client(test, max_pending=1)
+        assert len(errors) == 5
+        assert errors[0] == 'ValueError: unknown op: draw'
+        assert errors[-1] == 'deadline exceeded'
+        assert seconds < 1
+
+    def test_idle_connection(self):
+        async def test(client):
+            return await asyncio.wait_for(client.request(
+                'assign', self.file, **self.options), 10)
+
+        result = self.run_client(test, max_pending=1, num_idle=1)
+        assert_array_equal(result['t'], self.design.assignment_from_iid.t)
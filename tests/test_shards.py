@@ -0,0 +1,67 @@
+from os import path
+import json
+import tempfile
+
+import pandas as pd
+from parameterized import parameterized
+from numpy.testing import TestCase, assert_array_equal
+
+from ..design import QuantileTargetingRCT
+from ..balance import MahalanobisBalance
+from ..shards import save_design, run_shard, main
+
+
+class TestShards(TestCase):
+    def setUp(self):
+        self.file = path.join(path.dirname(__file__), 'test_data',
+                              'example_covariates.csv')
+        self.maha = MahalanobisBalance()
+        self.design = QuantileTargetingRCT(
+            self.maha, self.file, [.5, .5], .1, num_monte_carlo=60,
+            legacy_rng=False)
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    @parameterized.expand([[1, 'iid'], [4, 'shuffled'], [7, 'iid']])
+    def test_merge(self, num_shards, scheme):
+        summaries = [run_shard(self.design, shard, num_shards, scheme)
+                     for shard in reversed(range(num_shards))]
+        summaries = json.loads(json.dumps(summaries))
+        assert_array_equal(
+            self.design.merge_shards(summaries),
+            getattr(self.design, 'assignment_from_{}'.format(scheme)))
+        with self.assertRaises(ValueError):
+            self.design.merge_shards(summaries[1:])
+
+    def test_single_draws(self):
+        design = QuantileTargetingRCT(
+            lambda df, a: self.maha.balance_func(df, a), self.file, [.5, .5],
+            .1, num_monte_carlo=60, legacy_rng=False)
+        summaries = [design.run_shard('iid', start, stop)
+                     for start, stop in design.shard_ranges(3)]
+        assert_array_equal(design.merge_shards(summaries),
+                           design.assignment_from_iid)
+        other = QuantileTargetingRCT(
+            self.maha, self.file, [.5, .5], .2, num_monte_carlo=60,
+            legacy_rng=False)
+        with self.assertRaises(ValueError):
+            other.merge_shards(summaries)
+        with self.assertRaises(ValueError):
+            QuantileTargetingRCT(self.maha, self.file, [.5, .5], .1,
+                                 num_monte_carlo=60).run_shard('iid', 0, 30)
+
+    def test_main(self):
+        design_path = path.join(self.dir.name, 'design.pkl')
+        save_design(self.design, design_path)
+        summary_paths = [path.join(self.dir.name, '{}.json'.format(shard))
+                         for shard in range(3)]
+        for shard, summary_path in enumerate(summary_paths):
+            assert main(['run', design_path, str(shard), '3', '--scheme',
+                         'shuffled', '--output', summary_path]) == 0
+        output = path.join(self.dir.name, 'assignment.csv')
+        assert main(['merge', design_path] + summary_paths +
+                    ['--output', output]) == 0
+        assert_array_equal(pd.read_csv(output, index_col=0),
+                           self.design.assignment_from_shuffled)
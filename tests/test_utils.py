@@ -1,6 +1,14 @@
+from bisect import insort
+from collections import deque
+from operator import add, sub
+import pickle
+
+import numpy as np
 from numpy.testing import TestCase
+from parameterized import parameterized
 
-from ..utils import NumericFunction, LexTuple, QuantileTarget
+from ..utils import NumericFunction, Expression, Scale, LexTuple, \
+    QuantileTarget, RunStats, NO_STATS
 
 
 class TestNumericFunction(TestCase):
@@ -46,6 +54,44 @@ class TestNumericFunction(TestCase):
         assert (-self.f2)(1, 2) == -3
         assert (-self.f2 + self.g2)(1, 2) == -1
 
+    def test_batch(self):
+        f = NumericFunction(lambda x: 2 * x, lambda xs: 2 * np.array(xs))
+        h = NumericFunction(lambda x: x + 1, lambda xs: np.array(xs) + 1)
+        assert list((f - .5 * h).batch([1, 2])) == [1.0, 2.5]
+        assert list((-f + h).batch([1, 2])) == [0, -1]
+        assert (f + self.g).batch_func is None
+        with self.assertRaises(NotImplementedError):
+            self.f.batch([1])
+
+    def test_expression(self):
+        f = NumericFunction(np.abs, np.abs)
+        h = NumericFunction(np.square, np.square)
+        expression = f - .5 * h + self.g
+        assert isinstance(expression, Expression)
+        assert expression.op is add
+        assert expression.operands[0].op is sub
+        assert expression.leaves()[:2] == [f, h]
+        assert isinstance(expression.operands[0].operands[1].op, Scale)
+        assert repr(f + h) == 'add(NumericFunction({!r}), ' \
+            'NumericFunction({!r}))'.format(np.abs, np.square)
+        restored = pickle.loads(pickle.dumps(f - .5 * h))
+        assert list(restored.batch(np.array([-2, 2]))) == [0, 0]
+        assert restored.prepare(-4)() == 4 - 8
+
+    def test_shared_arguments(self):
+        calls = []
+
+        def share(*args):
+            calls.append(args)
+            return tuple(2 * x for x in args)
+
+        f = NumericFunction(lambda x: x, share_func=share)
+        expression = f + 3 * f - NumericFunction(lambda x: x)
+        assert expression(1) == 2 + 6 - 1
+        assert calls == [(1,)]
+        assert expression.prepare(1)() == 2 + 6 - 1
+        assert calls == [(1,), (1,), ()]
+
 
 class TestLexOrderedTuple(TestCase):
     def test_repr(self):
@@ -69,18 +115,110 @@ class TestLexOrderedTuple(TestCase):
         assert LexTuple(-1, 2) == (-1, 2)
 
 
+class TestRunStats(TestCase):
+    def test_stats(self):
+        progress = []
+        stats = RunStats(lambda done, total: progress.append((done, total)))
+        with stats.timer('draw'):
+            stats.count('draws', 3)
+        stats.count('draws')
+        stats.report(4, 10)
+        other = RunStats()
+        other.count('draws', 2)
+        other.set('retained', 5)
+        stats.merge(other)
+        assert stats.counters == dict(draws=6, retained=5)
+        assert stats.times['draw'] >= 0
+        assert progress == [(4, 10)]
+
+    def test_disabled(self):
+        with NO_STATS.timer('draw'):
+            NO_STATS.count('draws')
+        NO_STATS.report(1, 1)
+        assert NO_STATS.as_dict() == dict(times={}, counters={})
+
+
 class TestQuantileTarget:
 
-    def test_pop_insort(self):
+    def test_update(self):
         qs = QuantileTarget(.2, lambda x: x ** 2 - 1, range(10), 10)
-        qs._pop_insort(0, 1)
-        assert list(qs.quantiles) == [(0, 1)]
-        qs._pop_insort(3, 2)
-        assert list(qs.quantiles) == [(0, 1), (3, 2)]
-        qs._pop_insort(2, 6)
-        assert list(qs.quantiles) == [(2, 6), (3, 2)]
-        qs._pop_insort(2, 'b')
-        assert list(qs.quantiles) == [(2, 6), (3, 2)]
+        qs.update([0], [1])
+        assert qs.quantiles == [(0, 0)]
+        qs.update([3], [2])
+        assert qs.quantiles == [(0, 0), (3, 1)]
+        qs.update([2, 2, 2], [6, 5, 7])
+        assert qs.quantiles == [(2, 4), (3, 1)]
+        qs.update([2, np.nan], [8, 1])
+        assert qs.quantiles == [(2, 5), (3, 1)]
+        assert qs.num_draws == 7
+
+    @staticmethod
+    def _reference_quantiles(num, scores, samples):
+        quantiles = deque([], maxlen=num)
+        for i, (res, s) in enumerate(zip(scores, samples)):
+            if len(quantiles) < num:
+                insort(quantiles, LexTuple(res, s, i))
+            elif LexTuple(res, s) > quantiles[0]:
+                quantiles.popleft()
+                insort(quantiles, LexTuple(res, s, i))
+        return [(res, i) for res, _, i in quantiles]
+
+    @parameterized.expand([[list, 1], [list, 7], [np.array, 1],
+                           [np.array, 16]])
+    def test_matches_sorted_insertion(self, sample_type, batch_size):
+        rng = np.random.RandomState(0)
+        scores = rng.randint(0, 6, 300).astype(float)
+        samples = [sample_type(rng.randint(0, 3, 4)) for _ in scores]
+        for num in [2, 5, 40]:
+            qs = QuantileTarget(num, None, None, len(scores))
+            for i in range(0, len(scores), batch_size):
+                qs.update(scores[i:i + batch_size],
+                          samples[i:i + batch_size])
+            assert qs.quantiles == self._reference_quantiles(
+                num, scores, samples)
+
+    @parameterized.expand([[1], [7], [300]])
+    def test_redrawn_ties(self, batch_size):
+        rng = np.random.RandomState(2)
+        scores = rng.randint(0, 6, 300).astype(float)
+        samples = [list(rng.randint(0, 3, 4)) for _ in scores]
+        redrawn = []
+
+        def redraw(indices):
+            redrawn.extend(indices)
+            return [samples[i] for i in indices]
+
+        for num in [2, 5, 40]:
+            del redrawn[:]
+            qs = QuantileTarget(num, None, None, len(scores), redraw=redraw)
+            for i in range(0, len(scores), batch_size):
+                qs.update(scores[i:i + batch_size],
+                          samples[i:i + batch_size])
+            assert all(key is None for key in qs.tie_keys)
+            assert qs.quantiles == self._reference_quantiles(
+                num, scores, samples)
+            assert len(redrawn) == len(set(redrawn)) < 300
+        qs = QuantileTarget(.1, lambda x: x[0] // 2, iter(samples), 300,
+                            redraw=redraw)
+        qs.compute_best()
+        assert qs.quantiles == self._reference_quantiles(
+            30, [s[0] // 2 for s in samples], samples)
+
+    @parameterized.expand([[list], [np.array]])
+    def test_merge(self, sample_type):
+        rng = np.random.RandomState(1)
+        scores = rng.randint(0, 6, 300).astype(float)
+        samples = [sample_type(rng.randint(0, 3, 4)) for _ in scores]
+        for num in [2, 5, 40]:
+            shards = []
+            for start, stop in [(0, 70), (70, 71), (71, 200), (200, 300)]:
+                qs = QuantileTarget(num, None, None, 300, start=start)
+                qs.update(scores[start:stop], samples[start:stop])
+                shards.append(QuantileTarget.from_summary(qs.summary()))
+            merged = shards[0].merge(shards[1]).merge(shards[2])
+            merged.merge(shards[3])
+            assert merged.quantiles == self._reference_quantiles(
+                num, scores, samples)
 
     def test_quantile_target(self):
         qs = QuantileTarget(.2, lambda x: -x ** 2 + 2 * x, range(10), 10)
@@ -1,58 +1,276 @@
 from numbers import Number
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
 import abc
-from collections import deque
 import multiprocessing as mp
-from bisect import insort
+from operator import add, sub, mul, neg
+from functools import partial
+from itertools import islice
+
+import numpy as np
+
+SCORE_CHUNK = 1024
+
+
+class Scale:
+    """multiplication by a constant `factor`"""
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def __call__(self, value):
+        return self.factor * value
+
+    def __repr__(self):
+        return 'Scale({})'.format(self.factor)
 
 
 class NumericFunction:
+    """number valued function; functions combined with `+`, `-` and scalar
+    `*` form an `Expression` tree.
+
+    `batch_func` evaluates the function over a batch of arguments at once,
+    and `prepare_func` precomputes state for bound leading arguments.
+    `share_func` maps arguments to equivalent ones caching work that
+    functions with the same `share_func` share, such as assignment masks;
+    expressions call it once per evaluation for all such functions.
+    `swap_func(df, labels)` returns a SwapBalance scoring label swaps
+    incrementally, or None."""
+
     @classmethod
-    def numerize(cls, f):
-        return NumericFunction(f)
+    def numerize(cls, f, batch_func=None, prepare_func=None, share_func=None,
+                 swap_func=None):
+        return NumericFunction(f, batch_func, prepare_func, share_func,
+                               swap_func)
 
-    def __init__(self, f):
+    def __init__(self, f, batch_func=None, prepare_func=None,
+                 share_func=None, swap_func=None):
         self.func = f
+        self.batch_func = batch_func
+        self.prepare_func = prepare_func
+        self.share_func = share_func
+        self.swap_func = swap_func
 
     def __call__(self, *args, **kwargs):
         return self.func(*args, **kwargs)
 
+    def batch(self, *args, **kwargs):
+        """evaluates the function over a batch of arguments at once"""
+        if self.batch_func is None:
+            raise NotImplementedError('no batched evaluation available')
+        return self.batch_func(*args, **kwargs)
+
+    def prepare(self, *args):
+        """binds leading arguments once and returns a NumericFunction of the
+        remaining ones; functions with a `prepare_func` use it to precompute
+        state for the bound arguments"""
+        if self.prepare_func is not None:
+            return self.prepare_func(*args)
+        batch_func = None if self.batch_func is None else partial(
+            self.batch_func, *args)
+        return self.numerize(partial(self.func, *args), batch_func,
+                             share_func=self.share_func)
+
+    def leaves(self):
+        return [self]
+
+    def _prepare(self, shared, args):
+        return self.prepare(*shared.get(self.share_func, args))
+
+    def _evaluate(self, shared, args, kwargs):
+        return self.func(*shared.get(self.share_func, args), **kwargs)
+
+    def _evaluate_batch(self, shared, args, kwargs):
+        return self.batch_func(*shared.get(self.share_func, args), **kwargs)
+
+    @staticmethod
+    def as_function(f):
+        return f if isinstance(f, NumericFunction) else NumericFunction(f)
+
     def __add__(self, other):
-        def f(*args, **kwargs):
-            return self(*args, **kwargs) + other(*args, **kwargs)
-        return self.numerize(f)
+        return Expression(add, self, other)
 
     def __radd__(self, other):
-        return self.__add__(other)
+        return Expression(add, other, self)
 
     def __neg__(self):
-        def f(*args, **kwargs): return -self(*args, **kwargs)
-        return self.numerize(f)
+        return Expression(neg, self)
 
     def __sub__(self, other):
-        def f(*args, **kwargs):
-            return self(*args, **kwargs) - other(*args, **kwargs)
-        return self.numerize(f)
+        return Expression(sub, self, other)
 
     def __rsub__(self, other):
-        def f(*args, **kwargs):
-            return -self(*args, **kwargs) + other(*args, **kwargs)
-        return self.numerize(f)
+        return Expression(sub, other, self)
 
     def __mul__(self, other):
         if isinstance(other, Number):
-            def f(*args, **kwargs): return self(*args, **kwargs) * other
-            return self.numerize(f)
-        else:
-            def f(*args, **kwargs):
-                return self(*args, **kwargs) * other(*args, **kwargs)
-            return self.numerize(f)
+            return Expression(Scale(other), self)
+        return Expression(mul, self, other)
 
     def __rmul__(self, other):
-        return self.__mul__(other)
+        if isinstance(other, Number):
+            return Expression(Scale(other), self)
+        return Expression(mul, other, self)
 
     def __str__(self):
         return 'NumericFunction: number valued function'
 
+    def __repr__(self):
+        return 'NumericFunction({!r})'.format(self.func)
+
+
+class Expression(NumericFunction):
+    """`op` applied to the values of NumericFunction `operands` on the same
+    arguments; expressions pickle whenever their operations and leaf
+    functions do"""
+
+    def __init__(self, op, *operands):
+        self.op = op
+        self.operands = tuple(self.as_function(f) for f in operands)
+
+    @property
+    def func(self):
+        return self.__call__
+
+    @property
+    def batch_func(self):
+        if any(f.batch_func is None for f in self.leaves()):
+            return None
+        return self._batch
+
+    @property
+    def share_func(self):
+        return None
+
+    @property
+    def swap_func(self):
+        return None
+
+    def __call__(self, *args, **kwargs):
+        return self._evaluate(self.shared(args), args, kwargs)
+
+    def _batch(self, *args, **kwargs):
+        return self._evaluate_batch(self.shared(args), args, kwargs)
+
+    def prepare(self, *args):
+        return self._prepare(self.shared(args), args)
+
+    def _prepare(self, shared, args):
+        return Expression(self.op, *(f._prepare(shared, args)
+                                     for f in self.operands))
+
+    def leaves(self):
+        return [leaf for f in self.operands for leaf in f.leaves()]
+
+    def shared(self, args):
+        """arguments mapped by each distinct `share_func` of the leaves"""
+        shared = {}
+        for leaf in self.leaves():
+            if leaf.share_func is not None and leaf.share_func not in shared:
+                shared[leaf.share_func] = leaf.share_func(*args)
+        return shared
+
+    def _evaluate(self, shared, args, kwargs):
+        return self.op(*(f._evaluate(shared, args, kwargs)
+                         for f in self.operands))
+
+    def _evaluate_batch(self, shared, args, kwargs):
+        return self.op(*(f._evaluate_batch(shared, args, kwargs)
+                         for f in self.operands))
+
+    def __repr__(self):
+        return '{}({})'.format(getattr(self.op, '__name__', self.op),
+                               ', '.join(map(repr, self.operands)))
+
+
+class RunStats:
+    """wall times in seconds of the stages of design runs and counters of
+    their work; `progress(done, total)`, if given, is called as draws are
+    scored"""
+    enabled = True
+
+    def __init__(self, progress=None):
+        self.times = {}
+        self.counters = {}
+        self.progress = progress
+
+    @contextmanager
+    def timer(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[stage] = self.times.get(stage, 0.) + \
+                perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def report(self, done, total):
+        if self.progress is not None:
+            self.progress(done, total)
+
+    def merge(self, other):
+        for stage, seconds in other.times.items():
+            self.times[stage] = self.times.get(stage, 0.) + seconds
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def as_dict(self):
+        return dict(times=dict(self.times), counters=dict(self.counters))
+
+    def __repr__(self):
+        return 'RunStats({})'.format(self.as_dict())
+
+
+class DisabledStats(RunStats):
+    """instrumentation doing nothing, at the cost of a method call"""
+    enabled = False
+    _null_timer = nullcontext()
+
+    def timer(self, stage):
+        return self._null_timer
+
+    def count(self, name, n=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def report(self, done, total):
+        pass
+
+
+NO_STATS = DisabledStats()
+
+
+_worker_state = None
+
+
+def _init_worker(state):
+    global _worker_state
+    _worker_state = state
+
+
+def _call_worker_state(method, args):
+    return getattr(_worker_state, method)(*args)
+
+
+def map_on_workers(obj, method, arg_list, n_jobs, chunksize=None):
+    """calls `obj.method(*args)` for each `args` in `arg_list` and returns
+    the results in order; calls run in-process when `n_jobs` is 1, and on a
+    pool of `n_jobs` processes (all cpus when -1) holding a copy of `obj`
+    otherwise, sent `chunksize` calls at a time"""
+    if n_jobs == 1:
+        return [getattr(obj, method)(*args) for args in arg_list]
+    processes = None if n_jobs == -1 else n_jobs
+    with mp.Pool(processes, _init_worker, (obj,)) as pool:
+        return pool.map(partial(_call_worker_state, method), arg_list,
+                        chunksize)
+
 
 class OrderedTupleBase:
     def __init__(self, *args):
@@ -100,21 +318,236 @@ class LexTuple(OrderedTupleBase):
         return False
 
 
+def top_candidates(ranks, num):
+    """positions, in arrival order, of the candidates and of the kept draws
+    when streaming `ranks` and keeping the `num` highest.
+
+    Once `num` draws are kept, a draw is admitted only if ranked strictly
+    above the lowest kept draw, which it evicts, the earliest of equally
+    ranked draws going first. The kept draws are then those ranked above
+    the `num`-th highest rank v, and the latest v-ranked draws among the
+    first `num` draws ranked v or above. Candidates include all of these
+    v-ranked draws: they summarize a stream prefix for any continuation."""
+    positions = np.arange(len(ranks))
+    if len(ranks) <= num:
+        return positions, positions
+    if num <= 0:
+        return positions[:0], positions[:0]
+    lowest = np.partition(ranks, len(ranks) - num)[len(ranks) - num]
+    above = positions[ranks > lowest]
+    ties = positions[ranks >= lowest][:num]
+    ties = ties[ranks[ties] == lowest]
+    kept_ties = ties[len(ties) - (num - len(above)):]
+    return (np.sort(np.concatenate([above, ties])),
+            np.sort(np.concatenate([above, kept_ties])))
+
+
+def tie_ranks(scores, tie_keys=None):
+    """ranks ordering draws by score and then, among equal scores, by
+    `tie_keys`; equally ranked draws share a rank"""
+    if tie_keys is None:
+        return scores
+    order = np.argsort(scores, kind='stable')
+    ranks = np.empty(len(scores))
+    ranks[order] = np.arange(len(scores))
+    sorted_scores = scores[order]
+    starts = np.flatnonzero(np.diff(sorted_scores) == 0)
+    starts = starts[np.r_[True, np.diff(starts) > 1]] if len(starts) else []
+    for start in starts:
+        end = start + 1
+        while end < len(scores) and sorted_scores[end] == sorted_scores[start]:
+            end += 1
+        group = order[start:end]
+        try:
+            distinct = sorted(set(tie_keys[i] for i in group))
+        except TypeError:
+            ranks[group] = start
+            continue
+        position = dict((key, start + i) for i, key in enumerate(distinct))
+        ranks[group] = [position[tie_keys[i]] for i in group]
+    return ranks
+
+
 class QuantileTarget:
-    def __init__(self, q, objective_fun, generator_sample, len_generator):
+    """keeps the indices of the draws of a stream whose objective values
+    lie in the top `q` quantile, or of the top `q` draws if `q > 1`.
+
+    Draws are ranked by objective value, then by the draws themselves when
+    these are orderable (e.g. lists of labels, unlike numpy arrays).
+    Objective values are processed in batches when `batched` is True, in
+    which case `objective_fun` maps a batch of draws to their values, and
+    in chunks of single draws otherwise. Given `redraw`, mapping sorted
+    draw indices to the draws, lists of labels are not kept to break ties:
+    all draws tied with the lowest kept value are kept instead, and those
+    tied with others are redrawn once the stream is over. Selection times
+    and progress are recorded in `stats`.
+
+    Targets over consecutive ranges of a stream, the first draw of which
+    has index `start`, combine by `merge` into the target over the whole
+    range, which they can be rebuilt from by `summary` and
+    `from_summary`."""
+
+    def __init__(self, q, objective_fun, generator_sample, len_generator,
+                 batched=False, stats=NO_STATS, start=0, redraw=None):
         self.f = objective_fun
         self.generator = generator_sample
+        self.batched = batched
+        self.stats = stats
+        self.len_generator = len_generator
         self.num_q = q if q > 1 else int(q * len_generator)
-        self.quantiles = deque([], maxlen=self.num_q)
+        self.start = start
+        self.redraw = redraw
+        self.num_draws = 0
+        self.indices = np.empty(0, dtype=int)
+        self.scores = np.empty(0)
+        self.tie_keys = []
+        self._kept = np.empty(0, dtype=int)
+        self._deferred = False
 
     def compute_best(self):
-        for s in self.generator:
-            res = self.f(s)
-            self._pop_insort(res, s)
-
-    def _pop_insort(self, res, s):
-        if len(self.quantiles) < self.num_q:
-            insort(self.quantiles, LexTuple(res, s))
-        elif (res, s) > self.quantiles[0]:
-            self.quantiles.popleft()
-            insort(self.quantiles, LexTuple(res, s))
+        draws = iter(self.generator)
+        batches = draws if self.batched else iter(
+            lambda: list(islice(draws, SCORE_CHUNK)), [])
+        for batch in batches:
+            scores = self.f(batch) if self.batched else [
+                self.f(s) for s in batch]
+            with self.stats.timer('select'):
+                self.update(scores, batch)
+            self.stats.set('retained_candidates', len(self.indices))
+            self.stats.report(self.num_draws, self.len_generator)
+        with self.stats.timer('select'):
+            self.resolve_ties()
+
+    def update(self, scores, samples=None):
+        """adds the objective values of the next draws of the stream; the
+        draws themselves, if given, break ties when orderable"""
+        scores = np.asarray(scores, dtype=float).ravel()
+        scores = np.where(np.isnan(scores), -np.inf, scores)
+        indices = self.start + self.num_draws + np.arange(len(scores))
+        first = not self.num_draws
+        self.num_draws += len(scores)
+        tie_keys = self._tie_keys(samples, len(scores), first)
+        if len(self.indices) >= self.num_q > 0:
+            lowest = self._lowest()
+            sel = scores >= lowest if tie_keys is not None else \
+                scores > lowest
+            scores, indices = scores[sel], indices[sel]
+            if tie_keys is not None:
+                tie_keys = [key for key, s in zip(tie_keys, sel) if s]
+        self._merge(scores, indices, tie_keys)
+
+    def _lowest(self):
+        if self._deferred:
+            return np.partition(self.scores, -self.num_q)[-self.num_q]
+        return self.scores[self._kept].min()
+
+    def _tie_keys(self, samples, size, first):
+        if samples is None or self.tie_keys is None:
+            return self._drop_tie_keys()
+        if self.redraw is not None and (first or self._deferred) and \
+                len(samples) == size and \
+                all(isinstance(s, list) for s in samples):
+            self._deferred = True
+            return [None] * size
+        keys = [self._tie_key(s) for s in samples]
+        if self._deferred or len(keys) != size or \
+                any(key is None for key in keys):
+            return self._drop_tie_keys()
+        return keys
+
+    def _drop_tie_keys(self):
+        """stops breaking ties by draws; a deferred target holds all draws
+        tied with its lowest kept value, among which the earliest kept are
+        those kept when ties go by arrival order"""
+        self.tie_keys = None
+        if self._deferred:
+            self._deferred = False
+            self._select(self.scores, self.indices, None)
+
+    @staticmethod
+    def _tie_key(sample):
+        if isinstance(sample, np.ndarray):
+            return None
+        if isinstance(sample, list):
+            return np.asarray(sample, dtype='>u4').tobytes()
+        return sample
+
+    def _merge(self, scores, indices, tie_keys):
+        scores = np.concatenate([self.scores, scores])
+        indices = np.concatenate([self.indices, indices])
+        if tie_keys is not None:
+            tie_keys = self.tie_keys + tie_keys
+        if not self._deferred:
+            return self._select(scores, indices, tie_keys)
+        keep = np.full(len(scores), self.num_q > 0)
+        if len(scores) > self.num_q > 0:
+            keep = scores >= np.partition(scores, -self.num_q)[-self.num_q]
+        self.scores, self.indices = scores[keep], indices[keep]
+        self.tie_keys = [key for key, k in zip(tie_keys, keep) if k]
+
+    def _select(self, scores, indices, tie_keys):
+        candidates, kept = top_candidates(
+            tie_ranks(scores, tie_keys), self.num_q)
+        self.scores, self.indices = scores[candidates], indices[candidates]
+        if tie_keys is not None:
+            self.tie_keys = [tie_keys[i] for i in candidates]
+        self._kept = np.searchsorted(candidates, kept)
+
+    def resolve_ties(self):
+        """ranks the draws of a deferred target, redrawing those tied with
+        others"""
+        if not self._deferred:
+            return
+        self._deferred = False
+        values, counts = np.unique(self.scores, return_counts=True)
+        tied = np.flatnonzero(np.isin(self.scores, values[counts > 1]))
+        tie_keys = [None] * len(self.scores)
+        for i, sample in zip(tied, self.redraw(self.indices[tied])):
+            tie_keys[i] = self._tie_key(list(sample))
+        self._select(self.scores, self.indices, tie_keys)
+
+    def merge(self, other):
+        """adds the draws of `other`, a target over the draws following
+        those of this target"""
+        self.resolve_ties()
+        other.resolve_ties()
+        if other.start != self.start + self.num_draws or \
+                other.num_q != self.num_q:
+            raise ValueError('targets are not over consecutive draws')
+        tie_keys = None if self.tie_keys is None else other.tie_keys
+        if tie_keys is None:
+            self.tie_keys = None
+        self.num_draws += other.num_draws
+        self._merge(other.scores, other.indices, tie_keys)
+        return self
+
+    def summary(self):
+        """json serializable state of the target"""
+        self.resolve_ties()
+        return dict(
+            num_q=self.num_q, start=self.start, num_draws=self.num_draws,
+            scores=self.scores.tolist(), indices=self.indices.tolist(),
+            kept=self._kept.tolist(), tie_keys=None if self.tie_keys is None
+            else [key.hex() for key in self.tie_keys])
+
+    @classmethod
+    def from_summary(cls, summary):
+        target = cls(summary['num_q'], None, None, summary['num_draws'],
+                     start=summary['start'])
+        target.num_q = summary['num_q']
+        target.num_draws = summary['num_draws']
+        target.scores = np.array(summary['scores'], dtype=float)
+        target.indices = np.array(summary['indices'], dtype=int)
+        target._kept = np.array(summary['kept'], dtype=int)
+        target.tie_keys = None if summary['tie_keys'] is None else [
+            bytes.fromhex(key) for key in summary['tie_keys']]
+        return target
+
+    @property
+    def quantiles(self):
+        """(objective value, draw index) of kept draws, from lowest to
+        highest ranked, equally ranked draws in arrival order"""
+        self.resolve_ties()
+        ranks = tie_ranks(self.scores, self.tie_keys)[self._kept]
+        kept = self._kept[np.argsort(ranks, kind='stable')]
+        return list(zip(self.scores[kept], self.indices[kept]))